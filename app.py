@@ -1,5 +1,6 @@
 from flask import (
     Flask,
+    Request,
     render_template,
     request,
     redirect,
@@ -10,7 +11,17 @@ from flask import (
 )
 from pathlib import Path
 from werkzeug.utils import secure_filename
-import subprocess
+from urllib.parse import quote
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import contextlib
+import importlib
+import io
+import multiprocessing
+import sys
+import tempfile
+import threading
+import traceback
 import uuid
 import os
 import secrets
@@ -27,45 +38,158 @@ ALLOWED_MIME_TYPES = {
     "text/xml",
 }
 
+# Always use absolute paths and ensure writable directory for files
+BASE_DIR = Path(__file__).resolve().parent
+WORK_DIR = BASE_DIR / "uploads"
+WORK_DIR.mkdir(exist_ok=True)
+
+
+def _existing_script(name: str):
+    path = (BASE_DIR / name).resolve()
+    return path if path.exists() else None
+
+
+# Scripts are resolved and checked once at import time rather than on every request
+ENRICH_SCRIPT = _existing_script("find_amenities_near_route.py")
+# Map generator: prefer the Folium visualizer, fall back to generate_map.py
+MAP_SCRIPT = _existing_script("visualize_gpx_with_folium.py") or _existing_script("generate_map.py")
+
+
+class UploadRequest(Request):
+    """
+    Request that spools multipart file parts straight into WORK_DIR.
+    The upload view renames the part into its job directory, so the body is written to disk once
+    instead of SpooledTemporaryFile -> temp file -> FileStorage.save() copy.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        part = tempfile.NamedTemporaryFile(
+            "wb+", dir=WORK_DIR, prefix=".upload-", suffix=".part", delete=False, buffering=1 << 20
+        )
+        self.__dict__.setdefault("_upload_parts", []).append(part.name)
+        return part
+
+    def close(self):
+        super().close()
+        # Anything not moved into a job directory (rejected uploads, extra parts) is discarded
+        for name in self.__dict__.get("_upload_parts", ()):
+            try:
+                os.unlink(name)
+            except FileNotFoundError:
+                pass
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.secret_key = os.environ.get("FLASK_SECRET_KEY") or secrets.token_hex(32)
 app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_CONTENT_LENGTH", 20 * 1024 * 1024))
 csrf = CSRFProtect(app)
+# Let a fronting web server stream artifacts instead of a Python worker:
+# X-Sendfile (Apache/lighttpd) or nginx's X-Accel-Redirect to an internal location mapped onto uploads/
+app.use_x_sendfile = os.environ.get("USE_X_SENDFILE") == "1"
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX")  # e.g. "/_uploads/"
 
 
 @app.context_processor
 def inject_csrf_token():
     return dict(csrf_token=lambda: generate_csrf())
 
-# Always use absolute paths and ensure writable directory for files
-BASE_DIR = Path(__file__).resolve().parent
-WORK_DIR = BASE_DIR / "uploads"
-WORK_DIR.mkdir(exist_ok=True)
+# Modules the scripts import, and the scripts themselves (whichever MAP_SCRIPT resolved to, the
+# generate_map.py fallback included); loaded once per worker so each job skips the import cost
+PRELOAD_MODULES = (
+    "overpy", "lxml.etree", "numpy", "scipy.spatial", "folium",
+    *(script.stem for script in (ENRICH_SCRIPT, MAP_SCRIPT) if script is not None),
+)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
 
+_job_pool = None
+_job_pool_lock = threading.Lock()
 
-def run_script(script: Path, args: list, cwd: Path):
+
+def _preload_modules(script_dir: str):
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+    for name in PRELOAD_MODULES:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+
+
+def _run_script_job(script: str, args: list, cwd: str):
     """
-    Run a Python script in a subprocess; return (rc, stdout, stderr).
-    Ensures that both the script path and CWD are resolved.
+    Worker side of submit_job(): import the script as a module and call its main(argv) in-process.
+    Mirrors a subprocess run: CWD is set, stdout/stderr captured, exit code returned.
     """
-    script = script.resolve()
-    cwd = cwd.resolve()
+    out, err = io.StringIO(), io.StringIO()
+    saved_argv, saved_cwd = sys.argv, os.getcwd()
+    script_path = Path(script)
+    rc = 0
+    try:
+        # argparse takes prog from argv[0], keep usage/error text as it was from the command line
+        sys.argv = [script, *args]
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                if os.fspath(script_path.parent) not in sys.path:
+                    sys.path.insert(0, os.fspath(script_path.parent))
+                module = importlib.import_module(script_path.stem)
+                module.main(args)
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    rc = e.code
+                elif e.code is not None:
+                    print(e.code, file=sys.stderr)
+                    rc = 1
+            except BaseException:
+                traceback.print_exc()
+                rc = 1
+    finally:
+        sys.argv = saved_argv
+        os.chdir(saved_cwd)
+    return rc, out.getvalue(), err.getvalue()
+
+
+def _get_job_pool():
+    global _job_pool
+    with _job_pool_lock:
+        if _job_pool is None:
+            ctx = multiprocessing.get_context("spawn")
+            python_cmd = os.environ.get("PYTHON")
+            if python_cmd:
+                ctx.set_executable(os.fspath(Path(python_cmd).expanduser()))
+            _job_pool = ProcessPoolExecutor(
+                max_workers=max(1, JOB_WORKERS),
+                mp_context=ctx,
+                initializer=_preload_modules,
+                initargs=(os.fspath(BASE_DIR),),
+            )
+        return _job_pool
 
-    python_cmd = os.environ.get("PYTHON")
-    if python_cmd:
-        interpreter = os.fspath(Path(python_cmd).expanduser())
-    else:
-        interpreter = os.fspath(Path(os.sys.executable))
 
-    cmd = [interpreter, os.fspath(script), *args]
+def warm_job_pool():
+    """Start the worker processes now so their imports happen at boot, not on the first upload."""
+    pool = _get_job_pool()
+    for _ in range(max(1, JOB_WORKERS)):
+        pool.submit(os.getpid)
 
-    proc = subprocess.run(
-        cmd,
-        cwd=os.fspath(cwd),
-        capture_output=True,
-        text=True
-    )
-    return proc.returncode, proc.stdout, proc.stderr
+
+def submit_job(script: Path, args: list, cwd: Path):
+    """
+    Run a Python script on the persistent worker pool; return (rc, stdout, stderr).
+    Expects resolved paths (ENRICH_SCRIPT / MAP_SCRIPT and BASE_DIR already are).
+    """
+    global _job_pool
+    pool = _get_job_pool()
+    try:
+        return pool.submit(_run_script_job, os.fspath(script), list(args), os.fspath(cwd)).result()
+    except BrokenProcessPool as e:
+        # A worker died (e.g. OOM-killed); start a fresh pool for the next job
+        with _job_pool_lock:
+            if _job_pool is pool:
+                _job_pool = None
+        pool.shutdown(wait=False)
+        return 1, "", f"Worker process failed: {e}"
 
 
 @app.route("/")
@@ -107,7 +231,13 @@ def upload():
     job_dir.mkdir(parents=True, exist_ok=True)
 
     input_path = (job_dir / filename).resolve()
-    file.save(input_path)
+    part_name = getattr(file.stream, "name", None)
+    if isinstance(part_name, str) and Path(part_name).parent == WORK_DIR:
+        # Already on disk in WORK_DIR (see UploadRequest); a rename puts it in place without another copy
+        file.stream.flush()
+        os.replace(part_name, input_path)
+    else:
+        file.save(input_path)
 
     # Render configuration screen so user can tweak processing parameters before running
     return render_template(
@@ -212,16 +342,15 @@ def process(job_id):
 
     use_cache = request.form.get("no_cache") != "on"
 
-    enrich_script = (BASE_DIR / "find_amenities_near_route.py").resolve()
-
-    if not enrich_script.exists():
+    if ENRICH_SCRIPT is None:
         flash("Server misconfiguration: find_amenities_near_route.py not found.", "error")
         return redirect(url_for("index"))
 
     enriched_name = filename.rsplit(".", 1)[0] + "_amenities.gpx"
-    enriched_path = (job_dir / enriched_name).resolve()
+    # input_path was resolved and checked above; the outputs sit next to it
+    enriched_path = input_path.parent / enriched_name
     map_name = filename.rsplit(".", 1)[0] + "_map.html"
-    map_path = (job_dir / map_name).resolve()
+    map_path = input_path.parent / map_name
 
     args = [
         os.fspath(input_path),
@@ -235,8 +364,8 @@ def process(job_id):
     if not use_cache:
         args.append("--no-cache")
 
-    rc, out, err = run_script(
-        enrich_script,
+    rc, out, err = submit_job(
+        ENRICH_SCRIPT,
         args,
         cwd=BASE_DIR,
     )
@@ -246,15 +375,11 @@ def process(job_id):
     map_stdout = ""
     map_stderr = ""
     if success:
-        vis_script = (BASE_DIR / "visualize_gpx_with_folium.py").resolve()
-        fallback_script = (BASE_DIR / "generate_map.py").resolve()
-
-        script_to_use = vis_script if vis_script.exists() else fallback_script if fallback_script.exists() else None
-
-        if script_to_use:
-            rc_map, map_stdout, map_stderr = run_script(
-                script_to_use,
-                [os.fspath(enriched_path), "-o", os.fspath(map_path)],
+        if MAP_SCRIPT:
+            rc_map, map_stdout, map_stderr = submit_job(
+                MAP_SCRIPT,
+                # --gzip: a precompressed copy for the artifact route (see send_job_file)
+                [os.fspath(enriched_path), "-o", os.fspath(map_path), "--gzip"],
                 cwd=BASE_DIR,
             )
             if rc_map != 0 or not map_path.exists():
@@ -289,24 +414,67 @@ def process(job_id):
     )
 
 
+def job_file_mimetype(name: str):
+    """Content type an artifact is served with; a compressed copy (map.html.gz) is served as the .gz file it is,
+    not as the page inside it, which a browser would otherwise show as binary."""
+    mimetype, encoding = mimetypes.guess_type(name)
+    if encoding == "gzip":
+        return "application/gzip"
+    return mimetype or "application/octet-stream"
+
+
+def send_job_file(file_path: Path, as_attachment=False):
+    """send_file() for a checked path under WORK_DIR, offloaded to nginx when X_ACCEL_REDIRECT_PREFIX is set."""
+    mimetype = job_file_mimetype(file_path.name)
+    if not X_ACCEL_REDIRECT_PREFIX:
+        gz_path = file_path.with_name(file_path.name + ".gz")
+        if as_attachment or not gz_path.is_file():
+            return send_file(file_path, mimetype=mimetype, as_attachment=as_attachment)
+        # Precompressed by the map script; nginx does the same with gzip_static.
+        # Quality, not membership: "gzip;q=0" lists gzip only to refuse it
+        if request.accept_encodings["gzip"] > 0:
+            response = send_file(gz_path, mimetype=mimetype)
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = send_file(file_path, mimetype=mimetype)
+        response.vary.add("Accept-Encoding")
+        return response
+    response = app.response_class(mimetype=mimetype)
+    rel = file_path.relative_to(WORK_DIR).as_posix()
+    response.headers["X-Accel-Redirect"] = X_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(rel)
+    if as_attachment:
+        response.headers.set("Content-Disposition", "attachment", filename=file_path.name)
+    return response
+
+
+def job_file_path(job_id: str, filename: str):
+    """
+    Path of an artifact in a job directory, or None.
+    Job ids are alphanumeric and artifacts are flat files with secure names, so a plain string
+    check rules out traversal without resolve() or walking Path.parents.
+    """
+    if not job_id.isalnum() or secure_filename(filename) != filename:
+        return None
+    file_path = WORK_DIR / job_id / filename
+    return file_path if file_path.is_file() else None
+
+
 @app.route("/download/<job_id>/<path:filename>")
 def download(job_id, filename):
-    job_dir = (WORK_DIR / job_id)
-    file_path = (job_dir / filename).resolve()
-    if not file_path.exists() or WORK_DIR not in file_path.parents:
+    file_path = job_file_path(job_id, filename)
+    if file_path is None:
         flash("Requested file not found.", "error")
         return redirect(url_for("index"))
-    return send_file(file_path, as_attachment=True)
+    return send_job_file(file_path, as_attachment=True)
 
 
 @app.route("/artifact/<job_id>/<path:filename>")
 def artifact(job_id, filename):
-    job_dir = (WORK_DIR / job_id)
-    file_path = (job_dir / filename).resolve()
-    if not file_path.exists() or WORK_DIR not in file_path.parents:
+    file_path = job_file_path(job_id, filename)
+    if file_path is None:
         flash("Requested file not found.", "error")
         return redirect(url_for("index"))
-    return send_file(file_path)
+    return send_job_file(file_path)
 
 
 @app.errorhandler(CSRFError)
@@ -1,41 +1,67 @@
 #!/usr/bin/env python3
-import gpxpy, gpxpy.gpx
 import overpy
 import math
+import numpy as np
 import argparse
-import xml.sax.saxutils
 from urllib.parse import urlsplit, urlunsplit, quote, unquote
+from urllib.request import urlopen
+import re
 import time
 import random
 import os
 import json
 import hashlib
+from array import array
+import sqlite3
+import threading
 from types import SimpleNamespace
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lxml import etree
+
+from gpx_io import ROUTE_NS
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # scipy is optional; calculate_distances falls back to a linear NumPy scan
+    cKDTree = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the Overpass cache falls back to the stdlib json module
+    orjson = None
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; track sampling falls back to NumPy searchsorted
+    njit = None
 
 # --- Parameters ---
-DISTANCE_STEP = 500  # meters between sample points (increased to reduce API load)
-SEARCH_RADIUS = 300  # meters (reduced to reduce API load)
-AMENITY_FILTER = r"^(cafe|coffee_shop|restaurant|pub|bar|fast_food|toilets|drinking_water|fuel)$"
+AMENITY_FILTER = r"^(cafe|coffee|coffee_shop|restaurant|pub|bar|fast_food|toilets|drinking_water|fuel)$"
 SHOP_FILTER = r"^(cafe|coffee|coffee_shop)$"
 
-# --- Helper: XML escaping function ---
-def escape_xml(text):
-    """Properly escape XML content"""
-    if text is None:
-        return ""
-    return xml.sax.saxutils.escape(str(text), {'"': '&quot;', "'": '&apos;'})
+GPX_NS = "http://www.topografix.com/GPX/1/1"
+XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
 
 # --- Helper: sanitize URLs for XML attribute usage ---
-def sanitize_url(url: str) -> str:
-    """Return a safely escaped URL suitable for XML attribute values.
+# URLs that sanitize_url would return unchanged: http(s), plain host, only characters that are
+# neither quoted nor touched by the entity unescape ('%' and ';' excluded), and no empty query or
+# fragment for urlunsplit to drop
+_CLEAN_URL_RE = re.compile(r"^(?!.*\?#)https?://(?P<host>[A-Za-z0-9.\-]+)(?:/[A-Za-z0-9._~\-/?#\[\]@!$&'()*+,=]*)?(?<![?#])$")
+
+def sanitize_url(url: str) -> tuple:
+    """Return (url, netloc): a safely escaped URL suitable for XML attribute values, and its host.
     - Strips whitespace
     - Ensures scheme (defaults to https)
     - Percent-encodes unsafe characters in path/query/fragment while keeping reserved ones
     - Leaves XML escaping to the serializer (attribute context), but avoids stray control chars
     """
     if not url:
-        return url
+        return url, ""
     s = url.strip()
+    m = _CLEAN_URL_RE.match(s)
+    if m:
+        return s, m.group("host")
     # Unescape common HTML/XML entities that may be in OSM tags
     s = s.replace('&amp;', '&').replace('&quot;', '"').replace('&apos;', "'")
     parts = urlsplit(s if '://' in s else f'https://{s}')
@@ -46,10 +72,10 @@ def sanitize_url(url: str) -> str:
     fragment = quote(unquote(parts.fragment), safe=safe_set)
     netloc = parts.netloc
     scheme = parts.scheme or 'https'
-    return urlunsplit((scheme, netloc, path, query, fragment))
+    return urlunsplit((scheme, netloc, path, query, fragment)), netloc
 
 # --- CLI argument parsing ---
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Find amenities near a GPX route")
     parser.add_argument("input_file", help="Input GPX file path")
     parser.add_argument("-o", "--output", default=None, 
@@ -66,290 +92,572 @@ def parse_args():
     parser.add_argument("--retries", type=int, default=4,
                        help="Number of retries per batch on transient Overpass errors (default: 4)")
     parser.add_argument("--retry-backoff", type=float, default=2.0,
-                       help="Initial backoff in seconds for retries (exponential with jitter) (default: 2.0)")
+                       help="Base backoff in seconds for retries (exponential, full jitter) (default: 2.0)")
+    parser.add_argument("--retry-cap", type=float, default=60.0,
+                       help="Upper bound in seconds on a single retry backoff (default: 60)")
     parser.add_argument("--batch-sleep", type=float, default=0.5,
                        help="Seconds to sleep between successful batches to reduce server load (default: 0.5)")
+    parser.add_argument("--max-concurrency", type=int, default=2,
+                       help="Maximum number of Overpass batches in flight at once; public Overpass servers allow about 2 slots per IP (default: 2)")
     parser.add_argument("--endpoint", type=str, default=None,
                        help="Custom Overpass API endpoint URL (e.g., https://overpass-api.de/api/interpreter)")
     # Caching settings
     parser.add_argument("--cache-dir", type=str, default=".cache",
                        help="Directory to store Overpass cache files (default: .cache)")
-    parser.add_argument("--cache-ttl", type=int, default=24*3600,
-                       help="Cache time-to-live in seconds (default: 86400 = 24h)")
+    parser.add_argument("--cache-ttl-nodes", "--cache-ttl", dest="cache_ttl", type=int, default=7*86400,
+                       help="Cache time-to-live in seconds; Overpass data changes slowly (default: 604800 = 7 days)")
     parser.add_argument("--no-cache", action="store_true",
                        help="Disable local caching of Overpass results")
     # Query scope
     parser.add_argument("--nodes-only", action="store_true",
                        help="Query only node amenities and skip ways to reduce load")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     # Set default output filename if not provided
     if args.output is None:
-        import os
         base_name = os.path.splitext(args.input_file)[0]
         args.output = f"{base_name}_amenities.gpx"
     
     return args
 
-args = parse_args()
-
-# --- Parameters ---
-DISTANCE_STEP = args.distance_step  # meters between sample points
-SEARCH_RADIUS = args.search_radius  # meters
-AMENITY_FILTER = r"^(cafe|coffee|coffee_shop|restaurant|pub|bar|fast_food|toilets|drinking_water|fuel)$"
-
-# --- Helper: haversine distance (m) ---
-def haversine(lat1, lon1, lat2, lon2):
+# --- Helper: vectorized haversine distance (m) over NumPy arrays (degrees in) ---
+def haversine_np(lat1, lon1, lat2, lon2):
     R = 6371000
-    dlat, dlon = math.radians(lat2-lat1), math.radians(lon2-lon1)
-    a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1))*math.cos(math.radians(lat2))*math.sin(dlon/2)**2
-    return 2 * R * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2-lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+    return 2 * R * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
+# --- Helper: vectorized haversine (m) on radians, with cos(lat) supplied by the caller ---
+def haversine_rad(lat1_r, lon1_r, lat2_r, lon2_r, cos_lat1, cos_lat2):
+    """Same as haversine_np, but inputs are pre-converted so no radians()/cos() is redone per call."""
+    a = np.sin((lat2_r-lat1_r)/2)**2 + cos_lat1*cos_lat2*np.sin((lon2_r-lon1_r)/2)**2
+    return 2 * 6371000 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
+# --- Helper: JIT-compiled kernels (only when numba is installed) ---
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _hav_nb(lat1, lon1, lat2, lon2, cos_lat1, cos_lat2):
+        dlat, dlon = lat2 - lat1, lon2 - lon1
+        a = math.sin(dlat/2)**2 + cos_lat1*cos_lat2*math.sin(dlon/2)**2
+        return 2 * 6371000 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+
+    @njit(cache=True, fastmath=True)
+    def _sample_track_nb(lat_r, lon_r, cos_lat, step):
+        # One fused pass: cumulative distance for every point, and the same picks as the
+        # searchsorted path (first point at or past each multiple of step)
+        cum = np.empty(len(lat_r), dtype=np.float64)
+        out = np.empty(len(lat_r), dtype=np.int64)
+        n = 0
+        total = 0.0
+        threshold = 0.0
+        for i in range(len(lat_r)):
+            if i > 0:
+                total += _hav_nb(lat_r[i-1], lon_r[i-1], lat_r[i], lon_r[i], cos_lat[i-1], cos_lat[i])
+            cum[i] = total
+            if total >= threshold:
+                out[n] = i
+                n += 1
+                while threshold <= total:
+                    threshold += step
+        return cum, out[:n]
+
+    @njit(cache=True, fastmath=True)
+    def _nearest_route_nb(alat_r, alon_r, alat_cos, rlat_r, rlon_r, rcos):
+        # Same ranking as the NumPy fallback (squared equirectangular distance), without
+        # materialising any (amenities x route points) block; exact haversine to the winner
+        closest = np.empty(len(alat_r), dtype=np.int64)
+        dist = np.empty(len(alat_r), dtype=np.float64)
+        for i in range(len(alat_r)):
+            best, best_j = np.inf, 0
+            for j in range(len(rlat_r)):
+                dx = (rlon_r[j] - alon_r[i]) * alat_cos[i]
+                dy = rlat_r[j] - alat_r[i]
+                d2 = dx*dx + dy*dy
+                if d2 < best:
+                    best, best_j = d2, j
+            closest[i] = best_j
+            dist[i] = _hav_nb(rlat_r[best_j], rlon_r[best_j], alat_r[i], alon_r[i], rcos[best_j], alat_cos[i])
+        return closest, dist
 
 # --- Step 1: Load GPX and sample points every ≥500 m ---
-with open(args.input_file) as f:
-    gpx = gpxpy.parse(f)
-
-points = []
-dist_since_last = 0
-last_pt = None
-
-for trk in gpx.tracks:
-    for seg in trk.segments:
-        for p in seg.points:
-            if last_pt is None or haversine(last_pt.latitude, last_pt.longitude, p.latitude, p.longitude) >= DISTANCE_STEP:
-                points.append(p)
-                last_pt = p
-
-print(f"Sampled {len(points)} points along track")
+def load_track_coords(path):
+    """Stream <trkpt> lat/lon pairs straight into NumPy arrays without building a gpxpy DOM.
+    Returns two contiguous float64 arrays (lat, lon) rather than a list of tuples."""
+    lats = np.empty(4096, dtype=np.float64)
+    lons = np.empty(4096, dtype=np.float64)
+    n = 0
+    for _, el in etree.iterparse(path, events=("end",), tag="{*}trkpt"):
+        if n == len(lats):
+            # Point count is unknown up front; grow geometrically
+            lats = np.resize(lats, 2 * n)
+            lons = np.resize(lons, 2 * n)
+        lats[n] = float(el.get("lat"))
+        lons[n] = float(el.get("lon"))
+        n += 1
+        # Free the point (and already-seen siblings) as we go
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+    return lats[:n].copy(), lons[:n].copy()
+
+def sample_track(route, distance_step):
+    """Fill in route.cumulative (along-track distance in m for every point) and route.total, and
+    return the (lat, lon) sample points. One pass serves both Step 1 and Step 3, on the radians
+    and cos(lat) that build_route_index already computed."""
+    points = []
+    if route.count:
+        # Cumulative along-track distance, then pick the first point at or past each multiple of distance_step
+        if njit is not None:
+            trk_cum, sample_idx = _sample_track_nb(route.lat_r, route.lon_r, route.cos_lat, float(distance_step))
+        else:
+            # Each point's cos(lat) is shared by the segments on either side of it
+            lat_r, lon_r, cos_lat = route.lat_r, route.lon_r, route.cos_lat
+            seg = haversine_rad(lat_r[:-1], lon_r[:-1], lat_r[1:], lon_r[1:], cos_lat[:-1], cos_lat[1:])
+            trk_cum = np.concatenate(([0.0], np.cumsum(seg)))
+            sample_idx = np.unique(np.searchsorted(trk_cum, np.arange(0, trk_cum[-1] + 1, distance_step)))
+        # searchsorted can return len() for a threshold past the last point; drop it, then gather in bulk
+        sample_idx = sample_idx[sample_idx < route.count]
+        points = list(zip(route.lat[sample_idx].tolist(), route.lon[sample_idx].tolist()))
+        route.cumulative = trk_cum
+        route.total = float(trk_cum[-1])
+    return points
 
 # --- Step 2: Query Overpass with caching, batching & retries ---
 def ensure_dir(path: str):
     os.makedirs(path, exist_ok=True)
 
-def build_cache_key(points_list):
-    # Stable digest of sampled points and parameters impacting query outputs
-    pts_digest_src = ";".join(f"{p.latitude:.6f},{p.longitude:.6f}" for p in points_list)
-    pts_digest = hashlib.sha256(pts_digest_src.encode("utf-8")).hexdigest()
-    # Use input file identity to avoid cross-file collisions
-    try:
-        st = os.stat(args.input_file)
-        file_sig = f"{os.path.abspath(args.input_file)}|{int(st.st_mtime)}|{st.st_size}"
-    except Exception:
-        file_sig = os.path.abspath(args.input_file)
-    scope = "nodes" if args.nodes_only else "nodes_ways"
-    key = f"v2|{file_sig}|step={args.distance_step}|rad={args.search_radius}|filter={AMENITY_FILTER}|shop={SHOP_FILTER}|scope={scope}|pts={pts_digest}"
-    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
-    return digest
-
-def cache_paths(digest: str):
-    cache_base = os.path.join(args.cache_dir, "overpass")
-    ensure_dir(cache_base)
-    return os.path.join(cache_base, f"{digest}.json")
-
-def try_load_cache(digest: str):
+# Cache cells are sample points rounded to 3 decimals (~110 m). An element within the search radius
+# of a sample point is within radius + CELL_SLACK_M of its cell centre (half a cell diagonal, ~79 m)
+CELL_DECIMALS = 3
+CELL_SLACK_M = 80
+# Part of every cache key, so editing the tag filters invalidates old entries
+FILTER_VERSION = hashlib.sha256(f"v5|{AMENITY_FILTER}|{SHOP_FILTER}|bicycle".encode("utf-8")).hexdigest()[:12]
+
+_cache_lock = threading.Lock()
+
+# Amenities as they travel from Overpass (or the cache) to merge_batches; ways are placed at their center
+Node = namedtuple("Node", "id lat lon tags")
+Way = namedtuple("Way", "id center_lat center_lon tags")
+
+def dumps_json(obj):
+    return orjson.dumps(obj) if orjson is not None else json.dumps(obj)
+
+def loads_json(blob):
+    return orjson.loads(blob) if orjson is not None else json.loads(blob)
+
+def cell_key(args, lat, lon):
+    scope = "n" if args.nodes_only else "nw"
+    return f"{lat:.{CELL_DECIMALS}f},{lon:.{CELL_DECIMALS}f}|{args.search_radius}|{FILTER_VERSION}|{scope}"
+
+def cell_center(key):
+    lat, lon = key.split("|", 1)[0].split(",")
+    return float(lat), float(lon)
+
+def open_cache(args):
+    """Open (creating if needed) the SQLite cell cache, or return None when caching is disabled."""
     if args.no_cache:
         return None
-    path = cache_paths(digest)
-    if not os.path.exists(path):
-        return None
-    # TTL check by file mtime
-    age = time.time() - os.path.getmtime(path)
-    if age > args.cache_ttl:
-        return None
+    ensure_dir(args.cache_dir)
+    path = os.path.join(args.cache_dir, "overpass.sqlite")
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        nodes = [SimpleNamespace(id=n["id"], lat=float(n["lat"]), lon=float(n["lon"]), tags=n.get("tags", {})) for n in data.get("nodes", [])]
-        ways = [SimpleNamespace(id=w["id"], center_lat=float(w["center_lat"]), center_lon=float(w["center_lon"]), tags=w.get("tags", {}), nodes=[]) for w in data.get("ways", [])]
-        print(f"Loaded Overpass cache ({len(nodes)} nodes, {len(ways)} ways)")
-        return nodes, ways
-    except Exception as e:
-        print(f"Cache load failed, will re-query: {e}")
+        conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        conn.execute("CREATE TABLE IF NOT EXISTS cells (key TEXT PRIMARY KEY, created REAL, json BLOB)")
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Warning: cache unavailable, continuing without it: {e}")
         return None
+    return conn
 
-def save_cache(digest: str, nodes_list, ways_list):
-    if args.no_cache:
-        return
-    path = cache_paths(digest)
+def purge_expired_cache(args):
+    """Delete expired cells on a background thread; the caller joins it once the queries are done."""
+    def purge():
+        try:
+            conn = sqlite3.connect(os.path.join(args.cache_dir, "overpass.sqlite"), timeout=30)
+            with conn:
+                conn.execute("DELETE FROM cells WHERE created < ?", (time.time() - args.cache_ttl,))
+            conn.close()
+        except sqlite3.Error as e:
+            print(f"Warning: cache cleanup failed: {e}")
+    t = threading.Thread(target=purge, daemon=True)
+    t.start()
+    return t
+
+def load_cells(args, conn, keys):
+    """Return {key: (nodes, ways)} for the keys cached within the TTL."""
+    if conn is None or not keys:
+        return {}
+    cutoff = time.time() - args.cache_ttl
+    marks = ",".join("?" * len(keys))
     try:
+        with _cache_lock:
+            rows = conn.execute(f"SELECT key, json FROM cells WHERE created >= ? AND key IN ({marks})",
+                                (cutoff, *keys)).fetchall()
+    except sqlite3.Error as e:
+        print(f"Cache load failed, will re-query: {e}")
+        return {}
+    # Neighbouring cells overlap, so the same element comes back from several of them; build it
+    # once, and share identical tag dicts (e.g. a bare amenity=drinking_water) between elements
+    node_memo, way_memo, tag_memo = {}, {}, {}
+
+    def intern_tags(tags):
+        return tag_memo.setdefault(frozenset(tags.items()), tags)
+
+    def node(row):
+        if row[0] not in node_memo:
+            node_memo[row[0]] = Node(row[0], row[1], row[2], intern_tags(row[3]))
+        return node_memo[row[0]]
+
+    def way(row):
+        if row[0] not in way_memo:
+            way_memo[row[0]] = Way(row[0], row[1], row[2], intern_tags(row[3]))
+        return way_memo[row[0]]
+
+    found = {}
+    for key, blob in rows:
+        data = loads_json(blob)
+        found[key] = ([node(row) for row in data["nodes"]], [way(row) for row in data["ways"]])
+    return found
+
+def save_cells(conn, cells):
+    """Store {key: (nodes, ways)} for freshly queried cells."""
+    if conn is None or not cells:
+        return
+    now = time.time()
+    rows = []
+    for key, (nodes_list, ways_list) in cells.items():
+        # Positional [id, lat, lon, tags] rows rather than one dict per element: the field names
+        # would otherwise be repeated in every element of every cell
         serial = {
-            "created": time.time(),
-            "nodes": [
-                {"id": n.id, "lat": float(n.lat), "lon": float(n.lon), "tags": getattr(n, "tags", {})}
-                for n in nodes_list
-            ],
-            "ways": [
-                {"id": w.id, "center_lat": float(getattr(w, "center_lat", 0.0)), "center_lon": float(getattr(w, "center_lon", 0.0)), "tags": getattr(w, "tags", {})}
-                for w in ways_list
-            ]
+            "nodes": [[n.id, n.lat, n.lon, n.tags] for n in nodes_list],
+            "ways": [[w.id, w.center_lat, w.center_lon, w.tags] for w in ways_list],
         }
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(serial, f)
-        print(f"Saved Overpass cache → {path}")
-    except Exception as e:
+        rows.append((key, now, dumps_json(serial)))
+    try:
+        with _cache_lock, conn:
+            conn.executemany("INSERT OR REPLACE INTO cells (key, created, json) VALUES (?, ?, ?)", rows)
+    except sqlite3.Error as e:
         print(f"Warning: failed to save cache: {e}")
-def build_query_for_points(pts):
-    parts = []
-    for p in pts:
-        lat, lon = p.latitude, p.longitude
-        if args.nodes_only:
-            parts.append(f"""
-              node["amenity"~"{AMENITY_FILTER}"](around:{SEARCH_RADIUS},{lat},{lon});
-              node["shop"~"{SHOP_FILTER}"](around:{SEARCH_RADIUS},{lat},{lon});
-              node["shop"="bicycle"](around:{SEARCH_RADIUS},{lat},{lon});
-            """)
-        else:
-            parts.append(f"""
-              node["amenity"~"{AMENITY_FILTER}"](around:{SEARCH_RADIUS},{lat},{lon});
-              way["amenity"~"{AMENITY_FILTER}"](around:{SEARCH_RADIUS},{lat},{lon});
-              node["shop"~"{SHOP_FILTER}"](around:{SEARCH_RADIUS},{lat},{lon});
-              way["shop"~"{SHOP_FILTER}"](around:{SEARCH_RADIUS},{lat},{lon});
-              node["shop"="bicycle"](around:{SEARCH_RADIUS},{lat},{lon});
-              way["shop"="bicycle"](around:{SEARCH_RADIUS},{lat},{lon});
-            """)
-    # Use provided timeout
-    return f"[out:json][timeout:{args.overpass_timeout}];(\n{''.join(parts)});\nout center meta;"
-
-def run_query_with_retries(api, q, batch_idx, total_batches):
-    delay = args.retry_backoff
+
+def simplify_result(args, batch_res):
+    """Reduce an overpy result to the primitives we cache: nodes, plus ways placed at their center."""
+    nodes = [Node(n.id, float(n.lat), float(n.lon), n.tags) for n in batch_res.nodes]
+    ways = []
+    if not args.nodes_only:
+        for w in batch_res.ways:
+            c_lat = getattr(w, 'center_lat', None)
+            c_lon = getattr(w, 'center_lon', None)
+            if c_lat is None or c_lon is None:
+                # compute simple average if nodes present
+                try:
+                    if getattr(w, 'nodes', None):
+                        c_lat = sum(node.lat for node in w.nodes) / len(w.nodes)
+                        c_lon = sum(node.lon for node in w.nodes) / len(w.nodes)
+                except Exception:
+                    pass
+            if c_lat is None or c_lon is None:
+                # Skip if we truly cannot place the way
+                continue
+            ways.append(Way(w.id, float(c_lat), float(c_lon), w.tags))
+    return nodes, ways
+
+def batch_bbox(pts, radius):
+    """(south, west, north, east) covering every point of the batch plus the search radius."""
+    lats = [lat for lat, _ in pts]
+    lons = [lon for _, lon in pts]
+    dlat = radius / 111320
+    # Longitude degrees shrink with latitude; pad using the batch's most poleward latitude
+    max_abs_lat = min(max(abs(min(lats)), abs(max(lats))) + dlat, 89.9)
+    dlon = radius / (111320 * math.cos(math.radians(max_abs_lat)))
+    return (round(min(lats) - dlat, 6), round(min(lons) - dlon, 6),
+            round(max(lats) + dlat, 6), round(max(lons) + dlon, 6))
+
+# Tag statements are fixed per run; the batch bbox goes in the global [bbox:] setting, which
+# Overpass applies to every statement, so each query only adds its four coordinates
+NODE_STATEMENTS = "".join((
+    f'node["amenity"~"{AMENITY_FILTER}"];',
+    f'node["shop"~"{SHOP_FILTER}"];',
+    'node["shop"="bicycle"];',
+))
+NODE_WAY_STATEMENTS = "".join((
+    f'node["amenity"~"{AMENITY_FILTER}"];',
+    f'way["amenity"~"{AMENITY_FILTER}"];',
+    f'node["shop"~"{SHOP_FILTER}"];',
+    f'way["shop"~"{SHOP_FILTER}"];',
+    'node["shop"="bicycle"];',
+    'way["shop"="bicycle"];',
+))
+
+def build_query_for_points(args, pts, radius):
+    # One bbox per batch instead of an around: clause per point; results are cut back to the
+    # search radius client-side (filter_to_radius), so Overpass evaluates a handful of statements
+    bbox = ",".join(str(v) for v in batch_bbox(pts, radius))
+    statements = NODE_STATEMENTS if args.nodes_only else NODE_WAY_STATEMENTS
+    return f"[out:json][timeout:{args.overpass_timeout}][bbox:{bbox}];({statements});out center meta;"
+
+def within_radius(pts, radius, items, lat_attr, lon_attr):
+    """Boolean matrix, one row per item and one column per point: is the item within radius metres?"""
+    lat_r = np.radians([getattr(it, lat_attr) for it in items])[:, None]
+    lon_r = np.radians([getattr(it, lon_attr) for it in items])[:, None]
+    p_lat_r = np.radians([lat for lat, _ in pts])[None, :]
+    p_lon_r = np.radians([lon for _, lon in pts])[None, :]
+    # cos(lat) once per item and per point rather than per pair; and since the haversine term grows
+    # with distance, compare it against the radius's own term instead of taking arctan2 per pair
+    a = np.sin((p_lat_r - lat_r) / 2)**2 + np.cos(lat_r) * np.cos(p_lat_r) * np.sin((p_lon_r - lon_r) / 2)**2
+    return a <= math.sin(min(radius / (2 * 6371000), math.pi / 2))**2
+
+def filter_to_radius(pts, radius, nodes, ways):
+    """Keep only elements within radius metres of at least one of the batch's sample points."""
+    def keep(items, lat_attr, lon_attr):
+        if not items:
+            return items
+        mask = within_radius(pts, radius, items, lat_attr, lon_attr).any(axis=1)
+        return [it for it, k in zip(items, mask) if k]
+
+    return keep(nodes, "lat", "lon"), keep(ways, "center_lat", "center_lon")
+
+def split_by_cell(keys, radius, nodes, ways):
+    """Distribute a query result over the cells it was fetched for: {key: (nodes, ways)}."""
+    centers = [cell_center(k) for k in keys]
+
+    def per_cell(items, lat_attr, lon_attr):
+        if not items:
+            return [[] for _ in keys]
+        near = within_radius(centers, radius, items, lat_attr, lon_attr)
+        return [[it for it, k in zip(items, near[:, j]) if k] for j in range(len(keys))]
+
+    return dict(zip(keys, zip(per_cell(nodes, "lat", "lon"), per_cell(ways, "center_lat", "center_lon"))))
+
+# Lines of Overpass's /api/status page: a free slot now, or the seconds until each busy one frees up
+_SLOT_FREE_RE = re.compile(r"\d+ slots? available now")
+_SLOT_WAIT_RE = re.compile(r"in (\d+) seconds?")
+
+def overpass_slot_wait(api):
+    """Seconds until the server's next free slot for this client, from Overpass's /api/status.
+    Overpass 429 responses carry no Retry-After header (and overpy drops headers anyway); the status
+    page is where the server publishes the same information. Returns None if it cannot be read."""
+    status_url = api.url.rsplit("/", 1)[0] + "/status"
+    try:
+        with urlopen(status_url, timeout=10) as resp:
+            text = resp.read().decode("utf-8", "replace")
+    except Exception:
+        return None
+    if _SLOT_FREE_RE.search(text):
+        return 0.0
+    waits = [int(s) for s in _SLOT_WAIT_RE.findall(text)]
+    return float(min(waits)) if waits else None
+
+def run_query_with_retries(args, api, q, batch_idx, total_batches):
     for attempt in range(1, args.retries + 2):  # retries + initial try
         try:
             print(f"Batch {batch_idx}/{total_batches}: querying ({'attempt ' + str(attempt) if attempt>1 else 'try'})…")
             return api.query(q)
         except (overpy.exception.OverpassGatewayTimeout,
                 overpy.exception.OverpassTooManyRequests,
-                overpy.exception.MaxRetriesReached):
+                overpy.exception.MaxRetriesReached) as e:
             if attempt > args.retries:
                 raise
-            jitter = random.uniform(0, delay * 0.3)
-            sleep_s = delay + jitter
+            # "Full jitter" exponential backoff: uniform over [0, min(cap, base * 2^n)]
+            sleep_s = random.uniform(0, min(args.retry_cap, args.retry_backoff * 2 ** (attempt - 1)))
+            if isinstance(e, overpy.exception.OverpassTooManyRequests):
+                # Rate limited: don't come back before the server says a slot is free
+                slot_wait = overpass_slot_wait(api)
+                if slot_wait is not None:
+                    sleep_s = max(sleep_s, min(slot_wait, args.retry_cap))
             print(f"  Transient Overpass error, retrying in {sleep_s:.1f}s…")
             time.sleep(sleep_s)
-            delay *= 2
         except overpy.exception.OverpassBadRequest as e:
             # Query too big or malformed; no point retrying
             raise e
 
-# Initialize Overpass API
-api = overpy.Overpass(url=args.endpoint) if args.endpoint else overpy.Overpass()
-
-cache_digest = build_cache_key(points)
-cached = try_load_cache(cache_digest)
-if cached is not None:
-    result_nodes, result_ways = cached
-else:
-    final_nodes = {}
-    final_ways = {}
+def query_overpass(args, points):
+    """Query Overpass for amenities around the sample points.
+    Returns the de-duplicated amenities as columns (see merge_batches)."""
+    # Initialize Overpass API
+    api = overpy.Overpass(url=args.endpoint) if args.endpoint else overpy.Overpass()
 
     if not points:
-        result_nodes = []
-        result_ways = []
-    else:
-        total_batches = max(1, (len(points) + args.batch_size - 1) // args.batch_size)
-        print(f"Querying Overpass in {total_batches} batch(es)…")
-        for i in range(0, len(points), args.batch_size):
-            batch_pts = points[i:i+args.batch_size]
-            q = build_query_for_points(batch_pts)
-            batch_idx = (i // args.batch_size) + 1
+        return merge_batches([])
+
+    # One entry per cache cell: loops and out-and-back sections put several sample points in the same
+    # cell, and it only needs fetching once. Each cell keeps its points for the final radius filter.
+    cell_points = {}
+    for lat, lon in points:
+        cell_points.setdefault(cell_key(args, lat, lon), []).append((lat, lon))
+    keys = list(cell_points)
+    if len(keys) < len(points):
+        print(f"{len(points)} sample points fall in {len(keys)} distinct cells")
+
+    total_batches = max(1, (len(keys) + args.batch_size - 1) // args.batch_size)
+    print(f"Querying Overpass in {total_batches} batch(es)…")
+
+    cache = open_cache(args)
+    purger = purge_expired_cache(args) if cache is not None else None
+    cell_radius = args.search_radius + CELL_SLACK_M
+
+    def fetch_batch(batch_idx, keys):
+        # Cached per rounded sample point, so a new route or --distance-step reuses every cell it shares
+        # with earlier runs and only the missing cells go to Overpass
+        cells = load_cells(args, cache, keys)
+        missing = [k for k in keys if k not in cells]
+        if not missing:
+            print(f"Batch {batch_idx}/{total_batches}: loaded from cache ({len(keys)} cells)")
+        else:
+            q = build_query_for_points(args, [cell_center(k) for k in missing], cell_radius)
             try:
-                batch_res = run_query_with_retries(api, q, batch_idx, total_batches)
+                batch_res = run_query_with_retries(args, api, q, batch_idx, total_batches)
             except Exception as e:
                 print(f"Batch {batch_idx} failed permanently: {e}")
-                continue
-
-            # Aggregate without duplicates
-            for n in batch_res.nodes:
-                if n.id not in final_nodes:
-                    final_nodes[n.id] = n
-            if not args.nodes_only:
-                for w in batch_res.ways:
-                    if w.id not in final_ways:
-                        final_ways[w.id] = w
-
+                return None
+            fetched = split_by_cell(missing, cell_radius, *simplify_result(args, batch_res))
+            save_cells(cache, fetched)
+            cells.update(fetched)
             # Be nice to Overpass between batches
             time.sleep(max(0.0, args.batch_sleep))
-
-        result_nodes = list(final_nodes.values())
-        result_ways = [] if args.nodes_only else list(final_ways.values())
-
-    # Save cache on success
-    try:
-        # Convert Overpass objects to a storable list of primitives
-        store_nodes = result_nodes
-        store_ways = [] if args.nodes_only else []
-        if not args.nodes_only:
-            store_ways = []
-            for w in result_ways:
-                c_lat = getattr(w, 'center_lat', None)
-                c_lon = getattr(w, 'center_lon', None)
-                if c_lat is None or c_lon is None:
-                    # compute simple average if nodes present
-                    try:
-                        if getattr(w, 'nodes', None):
-                            c_lat = sum(node.lat for node in w.nodes) / len(w.nodes)
-                            c_lon = sum(node.lon for node in w.nodes) / len(w.nodes)
-                    except Exception:
-                        pass
-                # Wrap into a SimpleNamespace compatible for serialization
-                store_ways.append(SimpleNamespace(id=w.id, center_lat=c_lat or 0.0, center_lon=c_lon or 0.0, tags=getattr(w, 'tags', {})))
-        save_cache(cache_digest, store_nodes, store_ways)
-    except Exception as e:
-        print(f"Cache save skipped due to error: {e}")
-
-print(f"Found {len(result_nodes)} node amenities, {len(result_ways)} ways")
+        # Overpass returns elements in id order; keep that so cached and fresh runs agree
+        nodes = sorted({n.id: n for k in keys for n in cells[k][0]}.values(), key=lambda n: n.id)
+        ways = sorted({w.id: w for k in keys for w in cells[k][1]}.values(), key=lambda w: w.id)
+        batch_pts = [pt for k in keys for pt in cell_points[k]]
+        return filter_to_radius(batch_pts, args.search_radius, nodes, ways)
+
+    # Overpass requests are network-bound, so a few threads overlap the waiting
+    batches = [keys[i:i+args.batch_size] for i in range(0, len(keys), args.batch_size)]
+    results = [None] * len(batches)
+    with ThreadPoolExecutor(max_workers=max(1, args.max_concurrency)) as pool:
+        futures = {pool.submit(fetch_batch, i + 1, b): i for i, b in enumerate(batches)}
+        # Collect as batches finish, so one slow batch doesn't hold up the ones behind it
+        for done, fut in enumerate(as_completed(futures), 1):
+            results[futures[fut]] = fut.result()
+            if total_batches > 1:
+                print(f"  {done}/{total_batches} batch(es) done")
+    if cache is not None:
+        purger.join()
+        cache.close()
+
+    # Merge in batch order so the output is the same whatever order the batches finished in
+    return merge_batches(results)
+
+def merge_batches(results):
+    """Fold per-batch (nodes, ways) into one Structure-of-Arrays: id, lat and lon as NumPy columns plus a
+    parallel list of tag dicts, nodes first and ways placed at their center, each kind de-duplicated by id."""
+    node_cols = (array("q"), array("d"), array("d"), [])
+    way_cols = (array("q"), array("d"), array("d"), [])
+    seen_nodes, seen_ways = set(), set()
+
+    def take(items, seen, cols):
+        # Each batch is already unique by id, so one membership pass, one bulk set.update, and
+        # the Node/Way tuples transposed into the columns with zip(*...)
+        new = [it for it in items if it.id not in seen]
+        if new:
+            seen.update(it.id for it in new)
+            for col, values in zip(cols, zip(*new)):
+                col.extend(values)
+
+    for batch_res in results:
+        if batch_res is None:
+            continue
+        batch_nodes, batch_ways = batch_res
+        take(batch_nodes, seen_nodes, node_cols)
+        take(batch_ways, seen_ways, way_cols)
+    return SimpleNamespace(
+        id=np.concatenate((np.frombuffer(node_cols[0], dtype=np.int64), np.frombuffer(way_cols[0], dtype=np.int64))),
+        lat=np.concatenate((np.frombuffer(node_cols[1]), np.frombuffer(way_cols[1]))),
+        lon=np.concatenate((np.frombuffer(node_cols[2]), np.frombuffer(way_cols[2]))),
+        tags=node_cols[3] + way_cols[3],
+        node_count=len(node_cols[0]),
+        way_count=len(way_cols[0]),
+    )
 
 # --- Step 3: Calculate route points and cumulative distances ---
-route_points = []
-cumulative_distances = [0]  # Distance from start to each point along route
-
-for trk in gpx.tracks:
-    for seg in trk.segments:
-        for p in seg.points:
-            route_points.append((p.latitude, p.longitude))
-            if len(route_points) > 1:
-                # Calculate distance from previous point
-                prev_lat, prev_lon = route_points[-2]
-                curr_lat, curr_lon = route_points[-1]
-                dist = haversine(float(prev_lat), float(prev_lon), float(curr_lat), float(curr_lon))
-                cumulative_distances.append(cumulative_distances[-1] + dist)
-
-total_route_distance = cumulative_distances[-1] if cumulative_distances else 0
-print(f"Total route distance: {total_route_distance/1000:.1f} km")
-
-def calculate_distances(amenity_lat, amenity_lon):
-    """Calculate distances from amenity to route start, end, and closest point on route"""
-    if not route_points:
-        return 0, 0, 0
-    
-    amenity_lat, amenity_lon = float(amenity_lat), float(amenity_lon)
+def unit_vectors(lat_r, lon_r, cos_lat):
+    """(N, 3) Cartesian coordinates on the unit sphere for radian lat/lon arrays."""
+    return np.column_stack((cos_lat * np.cos(lon_r), cos_lat * np.sin(lon_r), np.sin(lat_r)))
+
+def build_route_index(route_lat, route_lon):
+    """Bundle the route arrays (and KD-tree, if scipy is available) used by sample_track and
+    calculate_distances; sample_track fills in the along-track distances."""
+    # Route coordinates in radians, plus cos(lat), reused for every amenity lookup
+    route_lat_r = np.radians(route_lat)
+    route_lon_r = np.radians(route_lon)
+
+    cos_lat = np.cos(route_lat_r)
+
+    # KD-tree over route points as 3-D unit vectors. Chord length is monotonic in great-circle
+    # distance, so the Euclidean nearest neighbour is the true nearest point anywhere on the
+    # globe (no projection distortion on long routes, no antimeridian seam).
+    tree = None
+    if cKDTree is not None and len(route_lat):
+        tree = cKDTree(unit_vectors(route_lat_r, route_lon_r, cos_lat))
+
+    return SimpleNamespace(
+        lat=route_lat, lon=route_lon, lat_r=route_lat_r, lon_r=route_lon_r, cos_lat=cos_lat,
+        count=len(route_lat), cumulative=np.zeros(len(route_lat)), total=0,
+        tree=tree,
+    )
+
+# Upper bound on cells in one (amenities x route points) distance block when no KD-tree is available
+DIST_MATRIX_CELLS = 1 << 21
+
+def calculate_distances(route, amenity_lats, amenity_lons):
+    """Calculate distances from each amenity to route start, end, and closest point on route.
+    Returns three arrays: km from start, km remaining, metres off route."""
+    amenity_lats = np.asarray(amenity_lats, dtype=np.float64)
+    amenity_lons = np.asarray(amenity_lons, dtype=np.float64)
+    count = len(amenity_lats)
+    if not route.count or count == 0:
+        zeros = np.zeros(count)
+        return zeros, zeros, zeros
     
-    # Find closest point on route and its index
-    min_dist_to_route = float('inf')
-    closest_index = 0
+    alat_r, alon_r = np.radians(amenity_lats), np.radians(amenity_lons)
+    alat_cos = np.cos(alat_r)
     
-    for i, (lat, lon) in enumerate(route_points):
-        dist = haversine(float(lat), float(lon), amenity_lat, amenity_lon)
-        if dist < min_dist_to_route:
-            min_dist_to_route = dist
-            closest_index = i
+    if route.tree is not None:
+        # O(log N) nearest route point per amenity; the chord converts exactly to great-circle metres
+        chord, closest = route.tree.query(unit_vectors(alat_r, alon_r, alat_cos))
+        min_dist_to_route = 2 * 6371000 * np.arcsin(np.minimum(chord / 2, 1.0))
+    elif njit is not None:
+        # No scipy: compiled scan over the route for each amenity
+        closest, min_dist_to_route = _nearest_route_nb(alat_r, alon_r, alat_cos,
+                                                       route.lat_r, route.lon_r, route.cos_lat)
+    else:
+        # Squared equirectangular distance matrix, a block of amenities at a time, argmin along the
+        # route axis. Only the ranking matters here and it is accurate at these ranges; no trig needed.
+        closest = np.empty(count, dtype=np.intp)
+        rows = max(1, DIST_MATRIX_CELLS // route.count)
+        for start in range(0, count, rows):
+            blk = slice(start, start + rows)
+            dx = (route.lon_r[None, :] - alon_r[blk, None]) * alat_cos[blk, None]
+            dy = route.lat_r[None, :] - alat_r[blk, None]
+            closest[blk] = (dx*dx + dy*dy).argmin(axis=1)
+        # Exact haversine only to the chosen point
+        min_dist_to_route = haversine_rad(route.lat_r[closest], route.lon_r[closest], alat_r, alon_r,
+                                          route.cos_lat[closest], alat_cos)
     
     # Distance along route to closest point (in km)
-    dist_from_start = cumulative_distances[closest_index] / 1000
+    dist_from_start = route.cumulative[closest] / 1000
     # Remaining distance along route (in km)  
-    dist_to_end = (total_route_distance - cumulative_distances[closest_index]) / 1000
+    dist_to_end = (route.total - route.cumulative[closest]) / 1000
     
     return dist_from_start, dist_to_end, min_dist_to_route
 
 # --- Step 4: Deduplicate & add waypoints ---
-seen = set()
-new_gpx = gpxpy.gpx.GPX()
-for trk in gpx.tracks:
-    new_gpx.tracks.append(trk)
-
-def add_wp(lat, lon, name, desc, amenity_type=None, tags=None):
-    # Calculate route distances
-    dist_start, dist_end, dist_route = calculate_distances(lat, lon)
-    
+# OSM amenity/shop value -> (GPX <sym>, GPX <type>)
+WAYPOINT_STYLES = {
+    'cafe': ('Restaurant', 'Cafe'),
+    'coffee': ('Restaurant', 'Cafe'),
+    'coffee_shop': ('Restaurant', 'Cafe'),
+    'restaurant': ('Restaurant', 'Restaurant'),
+    'pub': ('Restaurant', 'Pub/Bar'),
+    'bar': ('Restaurant', 'Pub/Bar'),
+    'fast_food': ('Restaurant', 'Fast Food'),
+    'toilets': ('Restroom', 'Toilets'),
+    'drinking_water': ('Water Source', 'Water Source'),
+    'fuel': ('Gas Station', 'Fuel Station'),
+    'bicycle': ('Bike Trail', 'Bike Shop'),  # shop=bicycle
+}
+DEFAULT_WAYPOINT_STYLE = ('Waypoint', 'Amenity')
+
+def format_wp(lat, lon, name, desc, dist_start, dist_end, dist_route, amenity_type=None, tags=None):
+    """Waypoint tuple (lat, lon, name, cmt, desc, link, symbol, type, distances) as consumed by write_wpt."""
     # Format description without "amenity=" prefix and add distance info
     clean_desc = desc.replace("amenity=", "").replace("shop=", "")
     distance_info = f"Route km: {dist_start:.1f}, Remaining: {dist_end:.1f}km, Off route: {dist_route:.0f}m"
@@ -365,104 +673,142 @@ def add_wp(lat, lon, name, desc, amenity_type=None, tags=None):
     else:
         full_desc = f"{clean_desc}. {distance_info}" if clean_desc else distance_info
     
-    # Create waypoint - gpxpy will handle XML escaping for text content
-    wpt = gpxpy.gpx.GPXWaypoint(latitude=lat, longitude=lon, name=name, description=full_desc)
-    
-    # Add link element safely (GPX 1.1: <link href="..."><text>..</text></link>)
+    # Link as (href, text) pair (GPX 1.1: <link href="..."><text>..</text></link>)
+    link = None
     if website:
-        safe_url = sanitize_url(website)
-        # Pre-escape for XML attribute context because gpxpy doesn't escape attribute values here
-        wpt.link = escape_xml(safe_url)
+        safe_url, host = sanitize_url(website)
         # Use hostname as link text when possible
-        try:
-            host = urlsplit(safe_url).netloc or safe_url
-        except Exception:
-            host = safe_url
-        wpt.link_text = host
-        wpt.link_type = 'text/html'
+        link = (safe_url, host or safe_url)
     
     # Set symbol and type based on amenity
-    if amenity_type:
-        if amenity_type in ['cafe', 'coffee', 'coffee_shop']:
-            wpt.symbol = 'Restaurant'
-            wpt.type = 'Cafe'
-        elif amenity_type == 'restaurant':
-            wpt.symbol = 'Restaurant'
-            wpt.type = 'Restaurant'
-        elif amenity_type in ['pub', 'bar']:
-            wpt.symbol = 'Restaurant'
-            wpt.type = 'Pub/Bar'
-        elif amenity_type == 'fast_food':
-            wpt.symbol = 'Restaurant'
-            wpt.type = 'Fast Food'
-        elif amenity_type == 'toilets':
-            wpt.symbol = 'Restroom'
-            wpt.type = 'Toilets'
-        elif amenity_type == 'drinking_water':
-            wpt.symbol = 'Water Source'
-            wpt.type = 'Water Source'
-        elif amenity_type == 'fuel':
-            wpt.symbol = 'Gas Station'
-            wpt.type = 'Fuel Station'
-        elif amenity_type == 'bicycle':  # shop=bicycle
-            wpt.symbol = 'Bike Trail'
-            wpt.type = 'Bike Shop'
-        else:
-            wpt.symbol = 'Waypoint'
-            wpt.type = 'Amenity'
-    else:
-        wpt.symbol = 'Waypoint'
-        wpt.type = 'Amenity'
+    symbol, wpt_type = WAYPOINT_STYLES.get(amenity_type, DEFAULT_WAYPOINT_STYLE)
     
-    new_gpx.waypoints.append(wpt)
-
-print("Processing amenities...")
-processed_count = 0
-for n in result_nodes:
-    if n.id in seen: continue
-    seen.add(n.id)
-    desc = ", ".join(f"{k}={v}" for k, v in n.tags.items() if k in ("amenity", "shop"))
-    amenity_type = n.tags.get("amenity") or n.tags.get("shop")
-    add_wp(n.lat, n.lon, n.tags.get("name", "Amenity"), desc, amenity_type, n.tags)
-    
-    processed_count += 1
-    if processed_count % 50 == 0:
-        print(".", end="", flush=True)
-
-for w in result_ways:
-    if w.id in seen:
-        continue
-    seen.add(w.id)
-    try:
-        center_lat = getattr(w, 'center_lat', None)
-        center_lon = getattr(w, 'center_lon', None)
-
-        if (center_lat is None or center_lon is None) and getattr(w, 'nodes', None):
-            try:
-                center_lat = sum(node.lat for node in w.nodes) / len(w.nodes)
-                center_lon = sum(node.lon for node in w.nodes) / len(w.nodes)
-            except Exception:
-                center_lat = center_lon = None
-
-        if center_lat is None or center_lon is None:
-            # Skip if we truly cannot place the way
-            continue
-
-        desc = ", ".join(f"{k}={v}" for k, v in w.tags.items() if k in ("amenity", "shop"))
-        amenity_type = w.tags.get("amenity") or w.tags.get("shop")
-        add_wp(center_lat, center_lon, w.tags.get("name", "Amenity"), desc, amenity_type, w.tags)
+    return (lat, lon, name, clean_desc, full_desc, link, symbol, wpt_type, (dist_start, dist_end, dist_route))
+
+def iter_waypoints(amenities, dists_start, dists_end, dists_route):
+    """Yield a formatted waypoint per amenity, printing a progress dot every 50."""
+    processed_count = 0
+    # Distances come back as arrays for all amenities at once; unbox them in bulk so the
+    # per-waypoint formatting works on plain floats rather than NumPy scalars
+    for lat, lon, tags, dist_start, dist_end, dist_route in zip(
+            amenities.lat.tolist(), amenities.lon.tolist(), amenities.tags,
+            dists_start.tolist(), dists_end.tolist(), dists_route.tolist()):
+        desc = ", ".join(f"{k}={v}" for k, v in tags.items() if k in ("amenity", "shop"))
+        amenity_type = tags.get("amenity") or tags.get("shop")
+        yield format_wp(lat, lon, tags.get("name", "Amenity"), desc, dist_start, dist_end, dist_route, amenity_type, tags)
 
         processed_count += 1
         if processed_count % 50 == 0:
             print(".", end="", flush=True)
-    except overpy.exception.DataIncomplete:
-        continue
-
-if processed_count % 50 != 0:
-    print()  # New line after progress dots
 
-# --- Step 4: Save new GPX ---
-with open(args.output, "w") as f:
-    f.write(new_gpx.to_xml())
-
-print(f"Saved enriched GPX → {args.output}")
+    if processed_count % 50 != 0:
+        print()  # New line after progress dots
+
+# --- Step 5: Save new GPX ---
+def gpx_tag(name):
+    return f"{{{GPX_NS}}}{name}"
+
+def write_text_el(xf, name, text):
+    with xf.element(gpx_tag(name)):
+        xf.write(text)
+
+def write_wpt(xf, lat, lon, name, cmt, desc, link, symbol, wpt_type, distances):
+    # Child order follows the GPX 1.1 wptType sequence; lxml escapes text and attribute values
+    with xf.element(gpx_tag("wpt"), lat=str(lat), lon=str(lon)):
+        write_text_el(xf, "name", name)
+        if cmt:
+            write_text_el(xf, "cmt", cmt)
+        write_text_el(xf, "desc", desc)
+        if link:
+            with xf.element(gpx_tag("link"), href=link[0]):
+                write_text_el(xf, "text", link[1])
+                write_text_el(xf, "type", "text/html")
+        write_text_el(xf, "sym", symbol)
+        write_text_el(xf, "type", wpt_type)
+        # The description keeps the same figures for people and other apps; these are for parsing
+        dist_start, dist_end, dist_route = distances
+        with xf.element(gpx_tag("extensions")):
+            with xf.element(f"{{{ROUTE_NS}}}dist"):
+                # Shortest round-trip repr, so a reader formatting these gets the description's figures
+                for tag, text in (("from_km", repr(dist_start)), ("remain_km", repr(dist_end)),
+                                  ("off_m", f"{dist_route:.0f}")):
+                    with xf.element(f"{{{ROUTE_NS}}}{tag}"):
+                        xf.write(text)
+
+def copy_element(xf, el, src_ns, out_tags):
+    """Re-emit a parsed element through xf, moving src_ns (GPX 1.0 or none) into the GPX 1.1 namespace.
+    out_tags caches input tag -> output tag; a track only uses a handful of distinct tags."""
+    # Elements are re-emitted one by one rather than with xf.write(el): lxml would redeclare the
+    # default namespace on every <trk>, which gpxpy's namespace stripping can't handle
+    tag = out_tags.get(el.tag)
+    if tag is None:
+        qname = etree.QName(el)
+        tag = out_tags[el.tag] = gpx_tag(qname.localname) if qname.namespace == src_ns else el.tag
+    with xf.element(tag, el.attrib):
+        if el.text:
+            xf.write(el.text)
+        for child in el:
+            if isinstance(child.tag, str):  # skip comments / processing instructions
+                copy_element(xf, child, src_ns, out_tags)
+            if child.tail:
+                xf.write(child.tail)
+
+def input_namespaces(path):
+    """Namespace declarations of the input's root element (e.g. Garmin extensions)."""
+    for _, root in etree.iterparse(path, events=("start",)):
+        return etree.QName(root).namespace, dict(root.nsmap)
+    return None, {}
+
+def iter_input_tracks(path):
+    """Yield the input's <trk> elements one at a time, discarding each once it has been written."""
+    for _, trk in etree.iterparse(path, events=("end",), tag="{*}trk"):
+        yield trk
+        trk.clear()
+        while trk.getprevious() is not None:
+            del trk.getparent()[0]
+
+def write_gpx(output, input_file, waypoints):
+    """Stream the document out element by element instead of building one big string with to_xml()."""
+    src_ns, src_nsmap = input_namespaces(input_file)
+    nsmap = {k: v for k, v in src_nsmap.items() if k is not None and v != src_ns}
+    nsmap.update({None: GPX_NS, "xsi": XSI_NS, "route": ROUTE_NS})
+    with etree.xmlfile(output, encoding="utf-8") as xf:
+        xf.write_declaration()
+        gpx_attrib = {
+            "version": "1.1",
+            "creator": "find_amenities_near_route.py",
+            f"{{{XSI_NS}}}schemaLocation": f"{GPX_NS} http://www.topografix.com/GPX/1/1/gpx.xsd",
+        }
+        with xf.element(gpx_tag("gpx"), gpx_attrib, nsmap=nsmap):
+            for wpt in waypoints:
+                write_wpt(xf, *wpt)
+            out_tags = {}
+            for trk in iter_input_tracks(input_file):
+                copy_element(xf, trk, src_ns, out_tags)
+
+# --- Main ---
+def run(args):
+    """Enrich args.input_file with nearby amenities and write args.output (see parse_args)."""
+    trk_lat, trk_lon = load_track_coords(args.input_file)
+    route = build_route_index(trk_lat, trk_lon)
+    points = sample_track(route, args.distance_step)
+    print(f"Sampled {len(points)} points along track")
+
+    amenities = query_overpass(args, points)
+    print(f"Found {amenities.node_count} node amenities, {amenities.way_count} ways")
+
+    print(f"Total route distance: {route.total/1000:.1f} km")
+
+    print("Processing amenities...")
+    # Amenities arrive as coordinate columns, so route distances are computed in one batch
+    dists_start, dists_end, dists_route = calculate_distances(route, amenities.lat, amenities.lon)
+
+    # Waypoints are formatted as the writer consumes them, so the whole set is never held in memory
+    write_gpx(args.output, args.input_file, iter_waypoints(amenities, dists_start, dists_end, dists_route))
+    print(f"Saved enriched GPX → {args.output}")
+
+def main(argv=None):
+    run(parse_args(argv))
+
+if __name__ == "__main__":
+    main()
@@ -1,147 +1,162 @@
 #!/usr/bin/env python3
-import gpxpy
 import folium
 import argparse
+from html import escape
 import os
-from folium import plugins
 from branca.element import Template, MacroElement
-import re
-import string
+from folium.elements import ElementAddToElement
 
+from gpx_io import parse_description, read_gpx, route_distances
+from map_html import CLUSTER_THRESHOLD, LEGEND_TEMPLATE, add_amenity_groups, amenity_cluster, save_map
+from route_polyline import SIMPLIFY_TOLERANCE, EncodedPolyLine, simplify_track
 
-def parse_args():
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Visualize GPX route with amenities using Folium")
     parser.add_argument("gpx_file", help="GPX file with route and amenities")
     parser.add_argument("-o", "--output", default=None,
                         help="Output HTML file (default: input filename with '.html' extension)")
-    return parser.parse_args()
+    parser.add_argument("--no-simplify", action="store_true",
+                        help="Draw every track point instead of a simplified route line")
+    parser.add_argument("--simplify-tolerance", type=float, default=SIMPLIFY_TOLERANCE,
+                        help="Largest distance the simplified route line may stray from the track, in degrees of latitude (default: %(default)s, about 5 m)")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Also write a gzip-compressed copy of the map next to it (<output>.gz)")
+    return parser.parse_args(argv)
+
+
+# Font Awesome (icon, marker color) by GPX <type>, with a fallback by GPX <sym>
+TYPE_ICONS = {
+    "Cafe": ("coffee", "orange"),
+    "Restaurant": ("cutlery", "red"),
+    "Pub/Bar": ("beer", "darkred"),     # <- fixed: use 'beer' instead of 'glass'
+    "Fast Food": ("cutlery", "pink"),
+    "Toilets": ("male", "blue"),
+    "Water Source": ("tint", "lightblue"),
+    "Fuel Station": ("car", "orange"),
+    "Bike Shop": ("bicycle", "green"),
+}
+SYMBOL_ICONS = {
+    "Restaurant": ("cutlery", "red"),
+    "Restroom": ("male", "blue"),
+    "Water Source": ("tint", "lightblue"),
+    "Gas Station": ("car", "orange"),
+    "Bike Trail": ("bicycle", "green"),
+    "Waypoint": ("info-circle", "gray"),
+}
+DEFAULT_ICON = ("info-circle", "gray")
 
 
 def get_amenity_icon_color(amenity_type, symbol):
     """Return appropriate Font Awesome icon name and color for amenity types."""
-    type_map = {
-        "Cafe": ("coffee", "orange"),
-        "Restaurant": ("cutlery", "red"),
-        "Pub/Bar": ("beer", "darkred"),     # <- fixed: use 'beer' instead of 'glass'
-        "Fast Food": ("cutlery", "pink"),
-        "Toilets": ("male", "blue"),
-        "Water Source": ("tint", "lightblue"),
-        "Fuel Station": ("car", "orange"),
-        "Bike Shop": ("bicycle", "green"),
-    }
-    if amenity_type in type_map:
-        return type_map[amenity_type]
-
-    icon_map = {
-        "Restaurant": ("cutlery", "red"),
-        "Restroom": ("male", "blue"),
-        "Water Source": ("tint", "lightblue"),
-        "Gas Station": ("car", "orange"),
-        "Bike Trail": ("bicycle", "green"),
-        "Waypoint": ("info-circle", "gray"),
-    }
-    return icon_map.get(symbol, ("info-circle", "gray"))
-
-
-
-def parse_description(desc: str):
-    """Extract distance fields and return (clean_desc, from_km, remain_km, off_m)."""
-    if not desc:
-        return "", None, None, None
-
-    m_start = re.search(r"Route km:\s*([0-9]+(?:\.[0-9]+)?)", desc)
-    m_rem = re.search(r"Remaining:\s*([0-9]+(?:\.[0-9]+)?)km", desc)
-    m_off = re.search(r"Off route:\s*([0-9]+)m", desc)
-
-    start_km = float(m_start.group(1)) if m_start else None
-    remain_km = float(m_rem.group(1)) if m_rem else None
-    off_m = int(m_off.group(1)) if m_off else None
-
-    clean = re.sub(r"\.?\s*Route km:\s*[0-9]+(?:\.[0-9]+)?", "", desc)
-    clean = re.sub(r"\,?\s*Remaining:\s*[0-9]+(?:\.[0-9]+)?km", "", clean)
-    clean = re.sub(r"\,?\s*Off route:\s*[0-9]+m", "", clean)
-    clean = re.sub(r"\.?\s*Website:\s*\S+", "", clean)
-    clean = clean.strip()
-    if clean.endswith("."):
-        clean = clean[:-1]
-    return clean, start_km, remain_km, off_m
-
-
-def create_folium_map(gpx_file, output_file):
-    with open(gpx_file, "r") as f:
-        gpx = gpxpy.parse(f)
-
-    track_points = []
-    for track in gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                track_points.append([point.latitude, point.longitude])
-
-    if not track_points:
+    return TYPE_ICONS.get(amenity_type) or SYMBOL_ICONS.get(symbol, DEFAULT_ICON)
+
+
+class AmenityMarkers(MacroElement):
+    """Amenity markers built in the browser from compact rows, added to their amenity type's group.
+    Equal (icon, color) pairs share one icon, so each is created once rather than once per marker;
+    popups and tooltips are put together from the row the first time they are shown."""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function() {
+                var groups = [
+                    {%- for group in this.groups.values() %}
+                    {{ group.get_name() }},
+                    {%- endfor %}
+                ];
+                var types = {{ this.type_labels|tojson }};
+                var icons = {};
+                function popup(row) {
+                    var dist = [];
+                    if (row[6] !== null) { dist.push("From start: " + row[6].toFixed(1) + " km"); }
+                    if (row[7] !== null) { dist.push("Remaining: " + row[7].toFixed(1) + " km"); }
+                    if (row[8] !== null) { dist.push("Off route: " + row[8] + " m"); }
+                    return "<b>" + row[5] + "</b><br>Type: " + types[row[4]] + "<br>" + dist.join("<br>")
+                        + (row[9] ? "<br><em>" + row[9] + "</em>" : "");
+                }
+                {{ this.rows|tojson }}.forEach(function(row) {
+                    var key = row[2] + "|" + row[3];
+                    var icon = icons[key] || (icons[key] = L.AwesomeMarkers.icon(
+                        {markerColor: row[3], iconColor: "white", icon: row[2], prefix: "fa"}
+                    ));
+                    L.marker([row[0], row[1]], {icon: icon})
+                        .bindPopup(function() { return popup(row); }, {maxWidth: 300})
+                        .bindTooltip(function() { return row[5] + " (" + types[row[4]] + ")"; }, {sticky: true})
+                        .addTo(groups[row[4]]);
+                });
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, groups, rows):
+        super().__init__()
+        self._name = "AmenityMarkers"
+        self.groups = groups
+        # Shown in popups and tooltips, so escaped like the rest of the row's text
+        self.type_labels = [escape(amenity_type) for amenity_type in groups]
+        self.rows = rows
+
+
+def create_folium_map(gpx_file, output_file, simplify=True, gzip_copy=False, simplify_tolerance=SIMPLIFY_TOLERANCE):
+    # One streaming pass: an (N, 2) track array and lightweight waypoint records
+    track_points, waypoints = read_gpx(gpx_file)
+
+    if not len(track_points):
         print("No track points found in GPX file")
         return
 
-    center_lat = sum(p[0] for p in track_points) / len(track_points)
-    center_lon = sum(p[1] for p in track_points) / len(track_points)
+    center_lat, center_lon = track_points.mean(axis=0).tolist()
 
-    m = folium.Map(location=[center_lat, center_lon], zoom_start=12, tiles="OpenStreetMap")
+    # The route line is drawn on one canvas rather than as an SVG path
+    m = folium.Map(location=[center_lat, center_lon], zoom_start=12, tiles="OpenStreetMap", prefer_canvas=True)
     map_var = m.get_name()
 
-    folium.PolyLine(track_points, color="blue", weight=4, opacity=0.8, popup="GPX Route").add_to(m)
+    # Points within the simplify tolerance of the simplified line add bytes but nothing visible
+    route = simplify_track(track_points, simplify_tolerance) if simplify else track_points
+    EncodedPolyLine(route, color="blue", weight=4, opacity=0.8, popup="GPX Route").add_to(m)
 
     # Start / End markers
-    folium.Marker(track_points[0], popup="Start", icon=folium.Icon(color="green", icon="play")).add_to(m)
-    folium.Marker(track_points[-1], popup="End", icon=folium.Icon(color="red", icon="stop")).add_to(m)
+    folium.Marker(track_points[0].tolist(), popup="Start", icon=folium.Icon(color="green", icon="play")).add_to(m)
+    folium.Marker(track_points[-1].tolist(), popup="End", icon=folium.Icon(color="red", icon="stop")).add_to(m)
 
     # Group waypoints by amenity type
-    amenity_groups = {}
-    use_cluster = len(gpx.waypoints) > 50
-    marker_cluster = None
-    if use_cluster:
-        marker_cluster = plugins.MarkerCluster(name="Amenities").add_to(m)
-
-    for waypoint in gpx.waypoints:
+    marker_cluster = amenity_cluster(m) if len(waypoints) > CLUSTER_THRESHOLD else None
+    amenity_groups, _ = add_amenity_groups(m, (waypoint.type or "Amenity" for waypoint in waypoints), marker_cluster)
+
+    # Marker rows for AmenityMarkers: [lat, lon, icon, color, group index, name, from km, remaining km,
+    # off route m, description]; distances are null when unknown
+    type_index = {amenity_type: i for i, amenity_type in enumerate(amenity_groups)}
+    marker_rows = []
+    for waypoint in waypoints:
         lat, lon = waypoint.latitude, waypoint.longitude
         name = waypoint.name or "Unnamed"
         description = waypoint.description or ""
-        symbol = waypoint.symbol or "Waypoint"
         amenity_type = waypoint.type or "Amenity"
-
-        icon_name, color = get_amenity_icon_color(amenity_type, symbol)
-        clean_desc, start_km, remain_km, off_m = parse_description(description)
-
-        dist_lines = []
-        if start_km is not None:
-            dist_lines.append(f"From start: {start_km:.1f} km")
-        if remain_km is not None:
-            dist_lines.append(f"Remaining: {remain_km:.1f} km")
-        if off_m is not None:
-            dist_lines.append(f"Off route: {off_m} m")
-
-        dist_html = "<br>".join(dist_lines)
-        popup_content = f"""
-        <b>{name}</b><br>
-        Type: {amenity_type}<br>
-        {dist_html}<br><em>{clean_desc}</em>
-        """
-
-        marker = folium.Marker(
-            [lat, lon],
-            popup=folium.Popup(popup_content, max_width=300),
-            tooltip=f"{name} ({amenity_type})",
-            icon=folium.Icon(color=color, icon=icon_name, prefix="fa"),
-        )
-
-        # Collect markers per type
-        if amenity_type not in amenity_groups:
-            if use_cluster and marker_cluster is not None:
-                group = plugins.FeatureGroupSubGroup(marker_cluster, name=amenity_type)
-            else:
-                group = folium.FeatureGroup(name=amenity_type)
-            amenity_groups[amenity_type] = group
-            group.add_to(m)
-
-    marker.add_to(amenity_groups[amenity_type])
+        icon_name, color = get_amenity_icon_color(amenity_type, waypoint.symbol or "Waypoint")
+
+        distances = route_distances(waypoint)
+        if distances is not None:
+            clean_desc = waypoint.comment or ""
+            start_km, remain_km, off_m = distances
+        else:
+            # Files enriched before the route extension existed
+            clean_desc, start_km, remain_km, off_m = parse_description(description)
+
+        # Popup text is plain text: escaped once here, assembled into HTML in the browser
+        marker_rows.append([
+            lat, lon, icon_name, color, type_index[amenity_type], escape(name),
+            None if start_km is None else round(start_km, 1),
+            None if remain_km is None else round(remain_km, 1),
+            off_m,
+            escape(clean_desc),
+        ])
+
+    # The markers themselves are built in the browser from the rows
+    AmenityMarkers(amenity_groups, marker_rows).add_to(m)
+
+    if marker_cluster is not None:
+        # All subgroups are populated by now: one bulk addLayers over every amenity marker
+        m.add_child(ElementAddToElement(marker_cluster.get_name(), m.get_name()))
 
     # Add legend for amenity groups actually present
     legend_items = []
@@ -159,185 +174,12 @@ def create_folium_map(gpx_file, output_file):
         legend_entries_html = "".join(
             f'<label class="legend-item"><input type="checkbox" data-layer="{item["layer"]}" checked>'
             f'<span class="legend-swatch" style="background:{item["color"]};"></span>'
-            f'<span class="legend-label"><i class="fa fa-{item["icon"]}"></i> {item["type"]}</span>'
+            f'<span class="legend-label"><i class="fa fa-{item["icon"]}"></i> {escape(item["type"])}</span>'
             '</label>'
             for item in legend_items
         )
 
-        legend_template_str = string.Template("""
-{% macro html(this, kwargs) %}
-<style>
-    .map-legend {
-        position: absolute;
-        bottom: 20px;
-        right: 20px;
-        z-index: 9999;
-        background: rgba(255, 255, 255, 0.95);
-        padding: 10px 12px;
-        border-radius: 6px;
-        box-shadow: 0 1px 4px rgba(0,0,0,0.25);
-        font: 12px/1.3 Arial, sans-serif;
-        min-width: 180px;
-    }
-    .map-legend .legend-header {
-        display: flex;
-        align-items: center;
-        justify-content: space-between;
-        margin-bottom: 6px;
-    }
-    .map-legend .legend-header h4 {
-        margin: 0;
-        font-size: 13px;
-        font-weight: 600;
-        color: #1f2329;
-    }
-    .map-legend .legend-collapse-btn {
-        border: 1px solid #bbb;
-        background: #f6f8fa;
-        padding: 0 6px;
-        cursor: pointer;
-        border-radius: 3px;
-        font-size: 13px;
-        line-height: 1.4;
-    }
-    .map-legend .legend-controls {
-        display: flex;
-        gap: 6px;
-        margin-bottom: 6px;
-    }
-    .map-legend .legend-btn {
-        border: 1px solid #bbb;
-        background: #f6f8fa;
-        padding: 2px 6px;
-        cursor: pointer;
-        border-radius: 3px;
-        font-size: 11px;
-        line-height: 1.2;
-    }
-    .map-legend .legend-btn:focus,
-    .map-legend .legend-collapse-btn:focus {
-        outline: 2px solid #0969da;
-        outline-offset: 1px;
-    }
-    .map-legend .legend-body {
-        display: flex;
-        flex-direction: column;
-        gap: 4px;
-    }
-    .map-legend .legend-item {
-        display: flex;
-        align-items: center;
-        gap: 6px;
-        color: #333;
-    }
-    .map-legend .legend-item input {
-        margin: 0;
-    }
-    .map-legend .legend-swatch {
-        display: inline-block;
-        width: 12px;
-        height: 12px;
-        border-radius: 3px;
-        box-shadow: inset 0 0 0 1px rgba(0,0,0,0.2);
-    }
-    .map-legend .legend-label i {
-        margin-right: 4px;
-        color: #555;
-    }
-    .map-legend.collapsed .legend-controls,
-    .map-legend.collapsed .legend-body {
-        display: none;
-    }
-</style>
-<div class="map-legend" id="amenity-legend" data-enhanced="false">
-    <div class="legend-header">
-        <h4>Amenities</h4>
-        <button type="button" class="legend-collapse-btn" aria-expanded="true" title="Collapse legend">-</button>
-    </div>
-    <div class="legend-controls">
-        <button type="button" class="legend-btn legend-btn-all">All</button>
-        <button type="button" class="legend-btn legend-btn-none">None</button>
-    </div>
-    <div class="legend-body">
-        $legend_entries_html
-    </div>
-</div>
-<script>
-(function() {
-    var mapName = "$map_var";
-    function getMap() {
-        try { return window[mapName]; } catch (err) { return null; }
-    }
-    function setup() {
-        var map = getMap();
-        var legend = document.getElementById("amenity-legend");
-        if (!map || !legend) {
-            setTimeout(setup, 120);
-            return;
-        }
-        if (legend.dataset.enhanced === "true") {
-            return;
-        }
-        legend.dataset.enhanced = "true";
-        var toggles = Array.prototype.slice.call(legend.querySelectorAll('input[type="checkbox"]'));
-        function getLayer(name) {
-            try { return window[name]; } catch (err) { return null; }
-        }
-        function setLayer(name, show) {
-            var layer = getLayer(name);
-            if (!layer) { return; }
-            if (show) {
-                if (!map.hasLayer(layer)) { map.addLayer(layer); }
-            } else {
-                if (map.hasLayer(layer)) { map.removeLayer(layer); }
-            }
-        }
-        toggles.forEach(function(cb) {
-            cb.addEventListener("change", function() {
-                setLayer(cb.dataset.layer, cb.checked);
-            });
-        });
-        function setAll(flag) {
-            toggles.forEach(function(cb) {
-                if (cb.checked !== flag) { cb.checked = flag; }
-                setLayer(cb.dataset.layer, flag);
-            });
-        }
-        var btnAll = legend.querySelector(".legend-btn-all");
-        if (btnAll) {
-            btnAll.addEventListener("click", function(e) {
-                e.preventDefault();
-                setAll(true);
-            });
-        }
-        var btnNone = legend.querySelector(".legend-btn-none");
-        if (btnNone) {
-            btnNone.addEventListener("click", function(e) {
-                e.preventDefault();
-                setAll(false);
-            });
-        }
-        var collapseBtn = legend.querySelector(".legend-collapse-btn");
-        if (collapseBtn) {
-            collapseBtn.addEventListener("click", function(e) {
-                e.preventDefault();
-                var collapsed = legend.classList.toggle("collapsed");
-                collapseBtn.textContent = collapsed ? "+" : "-";
-                collapseBtn.setAttribute("aria-expanded", String(!collapsed));
-            });
-        }
-    }
-    if (document.readyState === "loading") {
-        document.addEventListener("DOMContentLoaded", setup);
-    } else {
-        setup();
-    }
-})();
-</script>
-{% endmacro %}
-""")
-
-        legend_template = legend_template_str.substitute(
+        legend_template = LEGEND_TEMPLATE.substitute(
             legend_entries_html=legend_entries_html,
             map_var=map_var,
         )
@@ -347,14 +189,15 @@ def create_folium_map(gpx_file, output_file):
         m.get_root().add_child(legend_macro)
 
     # Save map
-    m.save(output_file)
+    save_map(m, output_file, gzip_copy)
     print(f"✅ Map saved to {output_file}")
 
 
-def main():
-    args = parse_args()
+def main(argv=None):
+    args = parse_args(argv)
     output_file = args.output or os.path.splitext(args.gpx_file)[0] + "_map.html"
-    create_folium_map(args.gpx_file, output_file)
+    create_folium_map(args.gpx_file, output_file, simplify=not args.no_simplify, gzip_copy=args.gzip,
+                      simplify_tolerance=args.simplify_tolerance)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,178 @@
+"""Streaming GPX reader shared by the map scripts: track coordinates and waypoints in one lxml pass."""
+from array import array
+from collections import namedtuple
+import hashlib
+import io
+import json
+import mmap
+import os
+import re
+import zipfile
+
+import numpy as np
+from lxml import etree
+
+# '&' not starting an entity or character reference, as found in some hand-edited GPX files
+_BARE_AMP_RE = re.compile(rb'&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;)')
+
+# Same attribute names as gpxpy's GPXWaypoint; fields missing from the file are None.
+# extensions holds the child elements of <extensions>, like gpxpy's waypoint.extensions.
+Waypoint = namedtuple('Waypoint', 'latitude longitude name description comment symbol type link link_text extensions')
+
+# Waypoint <extensions> carrying the route distances as numbers (written by find_amenities_near_route.py)
+ROUTE_NS = 'urn:x-gpx-route'
+
+def route_distances(waypoint):
+    """(from_km, remain_km, off_m) from the waypoint's route extension, or None if it has none."""
+    for ext in waypoint.extensions:
+        if ext.tag == f'{{{ROUTE_NS}}}dist':
+            values = {etree.QName(child).localname: child.text for child in ext}
+            try:
+                return float(values['from_km']), float(values['remain_km']), int(values['off_m'])
+            except (KeyError, TypeError, ValueError):
+                return None
+    return None
+
+# Distance fields as written by find_amenities_near_route.py, matched in one pass:
+# "<clean>. Route km: X, Remaining: Ykm, Off route: Zm[. Website: URL]"
+_DESC_RE = re.compile(
+    r"^(?:(?P<clean>.*?)\.\s*)?Route km:\s*(?P<start>[0-9]+(?:\.[0-9]+)?)"
+    r",\s*Remaining:\s*(?P<rem>[0-9]+(?:\.[0-9]+)?)km"
+    r",\s*Off route:\s*(?P<off>[0-9]+)m"
+    r"(?:\.\s*Website:\s*\S+)?$",
+    re.DOTALL,
+)
+# Fallback: each field on its own, captured and stripped by one sub() per field, in this order
+_FIELD_RES = (
+    re.compile(r"\.?\s*Route km:\s*(?P<start>[0-9]+(?:\.[0-9]+)?)"),
+    re.compile(r"\,?\s*Remaining:\s*(?P<rem>[0-9]+(?:\.[0-9]+)?)km"),
+    re.compile(r"\,?\s*Off route:\s*(?P<off>[0-9]+)m"),
+    re.compile(r"\.?\s*Website:\s*\S+"),
+)
+# Labels of the fields above; a description with none of them is plain text
+_DESC_LABELS = ('Route km:', 'Remaining:', 'Off route:', 'Website:')
+
+def parse_description(desc: str):
+    """Extract distance fields and return (clean_desc, from_km, remain_km, off_m)."""
+    if not desc:
+        return '', None, None, None
+
+    if not any(label in desc for label in _DESC_LABELS):
+        # Plain text: neither pattern can match
+        clean = desc.strip()
+        return (clean[:-1] if clean.endswith('.') else clean), None, None, None
+
+    m = _DESC_RE.match(desc)
+    # A label in the leading text is a repeated or moved field, which the fallback strips
+    if m and not any(label in (m.group('clean') or '') for label in _DESC_LABELS):
+        clean = (m.group('clean') or '').strip()
+        start_km, remain_km, off_m = float(m.group('start')), float(m.group('rem')), int(m.group('off'))
+    else:
+        # Hand-edited or older descriptions: pick up each field wherever it is, keeping its first value
+        fields = {}
+
+        def take(m):
+            if m.lastgroup:
+                fields.setdefault(m.lastgroup, m.group(m.lastgroup))
+            return ''
+
+        clean = desc
+        for field_re in _FIELD_RES:
+            clean = field_re.sub(take, clean)
+        clean = clean.strip()
+        start_km = float(fields['start']) if 'start' in fields else None
+        remain_km = float(fields['rem']) if 'rem' in fields else None
+        off_m = int(fields['off']) if 'off' in fields else None
+    if clean.endswith('.'):
+        clean = clean[:-1]
+    return clean, start_km, remain_km, off_m
+
+def read_gpx(gpx_file, cache_dir=None):
+    """Return (track, waypoints): an (N, 2) lat/lon array of all <trkpt>s and a list of Waypoint.
+    Files with bare '&' characters, which an XML parser rejects, are re-read with them escaped.
+    With cache_dir, the result is kept there and reused while the file's mtime and size are unchanged."""
+    if cache_dir is None:
+        return _parse_gpx(gpx_file)
+    st = os.stat(gpx_file)
+    stamp = np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+    key = hashlib.sha1(os.path.abspath(gpx_file).encode('utf-8')).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, f'gpx-{key}.npz')
+    cached = _load_cached(cache_file, stamp)
+    if cached is not None:
+        return cached
+    track, waypoints = _parse_gpx(gpx_file)
+    _save_cached(cache_file, stamp, track, waypoints)
+    return track, waypoints
+
+def _load_cached(cache_file, stamp):
+    try:
+        with np.load(cache_file) as cached:
+            if not np.array_equal(cached['stamp'], stamp):
+                return None
+            track = cached['track']
+            rows = json.loads(str(cached['waypoints']))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+    return track, [Waypoint(*row[:-1], [etree.fromstring(ext) for ext in row[-1]]) for row in rows]
+
+def _save_cached(cache_file, stamp, track, waypoints):
+    # Plain arrays and JSON text, so loading never needs pickle; extensions are kept as XML
+    rows = [[*wp[:-1], [etree.tostring(ext, encoding='unicode') for ext in wp.extensions]] for wp in waypoints]
+    tmp = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            np.savez(f, stamp=stamp, track=track, waypoints=np.array(json.dumps(rows)))
+        os.replace(tmp, cache_file)
+    except OSError:
+        pass  # the cache is best-effort; the parsed result is still returned
+
+def _parse_gpx(gpx_file):
+    try:
+        return _read_gpx(gpx_file)
+    except etree.XMLSyntaxError:
+        if not os.path.getsize(gpx_file):
+            raise  # nothing to map or repair
+        # Scan the mapped file directly rather than reading a full copy of it first
+        with open(gpx_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            fixed = _BARE_AMP_RE.sub(b'&amp;', mm)
+        return _read_gpx(io.BytesIO(fixed))
+
+def _read_gpx(source):
+    # Track coordinates go straight into flat double buffers and come back as one (N, 2) array
+    track_coords = array('d')
+    waypoints = []
+    for _, elem in etree.iterparse(source, events=('end',), tag=('{*}trkpt', '{*}wpt')):
+        lat, lon = float(elem.get('lat')), float(elem.get('lon'))
+        if etree.QName(elem).localname == 'trkpt':
+            track_coords.extend((lat, lon))
+        else:
+            waypoints.append(_waypoint(elem, lat, lon))
+        # Free each point once read, including the emptied siblings left behind in its parent
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    return np.frombuffer(track_coords).reshape(-1, 2), waypoints
+
+def _waypoint(elem, lat, lon):
+    # Direct children only, so a <link>'s own <type> isn't mistaken for the waypoint's
+    link = elem.find('{*}link')
+    if link is not None:
+        href, link_text = link.get('href'), link.findtext('{*}text')
+    else:
+        # GPX 1.0 spelling
+        href, link_text = elem.findtext('{*}url'), elem.findtext('{*}urlname')
+    ext = elem.find('{*}extensions')
+    return Waypoint(
+        lat, lon,
+        elem.findtext('{*}name'),
+        elem.findtext('{*}desc'),
+        elem.findtext('{*}cmt'),
+        elem.findtext('{*}sym'),
+        elem.findtext('{*}type'),
+        href,
+        link_text,
+        # Kept alive on their own once elem.clear() detaches them from the waypoint
+        list(ext) if ext is not None else [],
+    )
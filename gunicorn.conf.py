@@ -0,0 +1,10 @@
+# Picked up automatically by gunicorn when started from this directory (see Dockerfile).
+
+
+def post_worker_init(worker):
+    # Each Gunicorn worker owns a pool of script processes; spawn them and preload
+    # app.PRELOAD_MODULES (the scripts' libraries and the enrich and map scripts
+    # themselves) before the first request instead of during it.
+    from app import warm_job_pool
+
+    warm_job_pool()
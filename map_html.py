@@ -0,0 +1,270 @@
+"""Pieces shared by the map scripts' folium maps, and writing the maps to disk."""
+import contextlib
+from collections import Counter
+import gzip
+import os
+import string
+
+from branca.element import Element
+import folium
+from folium import plugins
+
+# Name folium registers the Font Awesome stylesheet under in the page header (folium.Map.default_css)
+_FONT_AWESOME_CSS = 'awesome_markers_font_css'
+
+def compact_markup(text):
+    """text with each line's indentation, blank lines and whole-line // comments dropped.
+    Line breaks are kept, so a trailing // comment or a statement without its ';' still ends where it did."""
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+# Collapsible amenity legend with per-type layer checkboxes; $legend_entries_html and $map_var are filled in per map
+LEGEND_TEMPLATE = string.Template(compact_markup("""
+{% macro html(this, kwargs) %}
+<style>
+    .map-legend {
+        position: absolute;
+        bottom: 20px;
+        right: 20px;
+        z-index: 9999;
+        background: rgba(255, 255, 255, 0.95);
+        padding: 10px 12px;
+        border-radius: 6px;
+        box-shadow: 0 1px 4px rgba(0,0,0,0.25);
+        font: 12px/1.3 Arial, sans-serif;
+        min-width: 180px;
+    }
+    .map-legend .legend-header {
+        display: flex;
+        align-items: center;
+        justify-content: space-between;
+        margin-bottom: 6px;
+    }
+    .map-legend .legend-header h4 {
+        margin: 0;
+        font-size: 13px;
+        font-weight: 600;
+        color: #1f2329;
+    }
+    .map-legend .legend-collapse-btn {
+        border: 1px solid #bbb;
+        background: #f6f8fa;
+        padding: 0 6px;
+        cursor: pointer;
+        border-radius: 3px;
+        font-size: 13px;
+        line-height: 1.4;
+    }
+    .map-legend .legend-controls {
+        display: flex;
+        gap: 6px;
+        margin-bottom: 6px;
+    }
+    .map-legend .legend-btn {
+        border: 1px solid #bbb;
+        background: #f6f8fa;
+        padding: 2px 6px;
+        cursor: pointer;
+        border-radius: 3px;
+        font-size: 11px;
+        line-height: 1.2;
+    }
+    .map-legend .legend-btn:focus,
+    .map-legend .legend-collapse-btn:focus {
+        outline: 2px solid #0969da;
+        outline-offset: 1px;
+    }
+    .map-legend .legend-body {
+        display: flex;
+        flex-direction: column;
+        gap: 4px;
+    }
+    .map-legend .legend-item {
+        display: flex;
+        align-items: center;
+        gap: 6px;
+        color: #333;
+    }
+    .map-legend .legend-item input {
+        margin: 0;
+    }
+    .map-legend .legend-swatch {
+        display: inline-block;
+        width: 12px;
+        height: 12px;
+        border-radius: 3px;
+        box-shadow: inset 0 0 0 1px rgba(0,0,0,0.2);
+    }
+    .map-legend .legend-label i {
+        margin-right: 4px;
+        color: #555;
+    }
+    .map-legend.collapsed .legend-controls,
+    .map-legend.collapsed .legend-body {
+        display: none;
+    }
+</style>
+<div class="map-legend" id="amenity-legend" data-enhanced="false">
+    <div class="legend-header">
+        <h4>Amenities</h4>
+        <button type="button" class="legend-collapse-btn" aria-expanded="true" title="Collapse legend">-</button>
+    </div>
+    <div class="legend-controls">
+        <button type="button" class="legend-btn legend-btn-all">All</button>
+        <button type="button" class="legend-btn legend-btn-none">None</button>
+    </div>
+    <div class="legend-body">
+        $legend_entries_html
+    </div>
+</div>
+<script>
+(function() {
+    var mapName = "$map_var";
+    function getMap() {
+        try { return window[mapName]; } catch (err) { return null; }
+    }
+    function setup() {
+        var map = getMap();
+        var legend = document.getElementById("amenity-legend");
+        if (!map || !legend) {
+            setTimeout(setup, 120);
+            return;
+        }
+        if (legend.dataset.enhanced === "true") {
+            return;
+        }
+        legend.dataset.enhanced = "true";
+        var toggles = Array.prototype.slice.call(legend.querySelectorAll('input[type="checkbox"]'));
+        function getLayer(name) {
+            try { return window[name]; } catch (err) { return null; }
+        }
+        function setLayer(name, show) {
+            var layer = getLayer(name);
+            if (!layer) { return; }
+            if (show) {
+                if (!map.hasLayer(layer)) { map.addLayer(layer); }
+            } else {
+                if (map.hasLayer(layer)) { map.removeLayer(layer); }
+            }
+        }
+        toggles.forEach(function(cb) {
+            cb.addEventListener("change", function() {
+                setLayer(cb.dataset.layer, cb.checked);
+            });
+        });
+        function setAll(flag) {
+            toggles.forEach(function(cb) {
+                if (cb.checked !== flag) { cb.checked = flag; }
+                setLayer(cb.dataset.layer, flag);
+            });
+        }
+        var btnAll = legend.querySelector(".legend-btn-all");
+        if (btnAll) {
+            btnAll.addEventListener("click", function(e) {
+                e.preventDefault();
+                setAll(true);
+            });
+        }
+        var btnNone = legend.querySelector(".legend-btn-none");
+        if (btnNone) {
+            btnNone.addEventListener("click", function(e) {
+                e.preventDefault();
+                setAll(false);
+            });
+        }
+        var collapseBtn = legend.querySelector(".legend-collapse-btn");
+        if (collapseBtn) {
+            collapseBtn.addEventListener("click", function(e) {
+                e.preventDefault();
+                var collapsed = legend.classList.toggle("collapsed");
+                collapseBtn.textContent = collapsed ? "+" : "-";
+                collapseBtn.setAttribute("aria-expanded", String(!collapsed));
+            });
+        }
+    }
+    if (document.readyState === "loading") {
+        document.addEventListener("DOMContentLoaded", setup);
+    } else {
+        setup();
+    }
+})();
+</script>
+{% endmacro %}
+"""))
+
+# Waypoint count above which the amenity markers are clustered; below it they are few enough to draw directly
+CLUSTER_THRESHOLD = 100
+# Zoom from which amenity markers are shown one by one rather than clustered
+UNCLUSTER_ZOOM = 17
+
+def amenity_cluster(m):
+    """MarkerCluster for the amenity markers, kept off the map so it clusters them in one batch once its subgroups are filled."""
+    return plugins.MarkerCluster(
+        name='Amenities', show=False, chunkedLoading=True, disableClusteringAtZoom=UNCLUSTER_ZOOM
+    ).add_to(m)
+
+def add_amenity_groups(m, amenity_types, cluster=None):
+    """Add one layer group per amenity type to m, most common type first; subgroups of cluster if given.
+    Returns {type: group} and the [(type, count)] pairs, both in that order."""
+    type_counts = Counter(amenity_types).most_common()
+    groups = {}
+    for amenity_type, _ in type_counts:
+        if cluster is not None:
+            group = plugins.FeatureGroupSubGroup(cluster, name=amenity_type)
+        else:
+            group = folium.FeatureGroup(name=amenity_type)
+        groups[amenity_type] = group.add_to(m)
+    return groups, type_counts
+
+def print_map_report(output_file, route_points, waypoints, type_counts):
+    """Print where the map was saved and its statistics; type_counts are (type, count) pairs as listed."""
+    lines = [
+        f'Interactive map saved to: {output_file}',
+        f'Open in browser: file://{os.path.abspath(output_file)}',
+        '',
+        'Map Statistics:',
+        f'- Route points: {route_points}',
+        f'- Waypoints: {waypoints}',
+        f'- Amenity types: {len(type_counts)}',
+    ]
+    lines.extend(f'  - {amenity_type}: {count}' for amenity_type, count in type_counts)
+    print('\n'.join(lines))
+
+def _defer_font_awesome(root):
+    """Load the Font Awesome stylesheet without holding up first paint, and start on its solid webfont early.
+    The stylesheet only styles icon glyphs; everything else on the page draws without it."""
+    link = root.header._children.get(_FONT_AWESOME_CSS)
+    if link is None:
+        return
+    url = link.url
+    font_url = url.rsplit('/css/', 1)[0] + '/webfonts/fa-solid-900.woff2'
+    # Same name, so the replacement keeps the link's place in the header
+    root.header.add_child(Element(
+        f'<link rel="preload" as="font" type="font/woff2" href="{font_url}" crossorigin>\n'
+        f'    <link rel="stylesheet" href="{url}" media="print" onload="this.media=\'all\'"/>\n'
+        f'    <noscript><link rel="stylesheet" href="{url}"/></noscript>'
+    ), name=_FONT_AWESOME_CSS)
+
+def save_map(m, output_file, gzip_copy=False):
+    """Write the map's HTML page to output_file, streamed out as the page template renders.
+    Same page as m.save() (apart from the deferred Font Awesome stylesheet), without holding the whole
+    page and an encoded copy of it in memory.
+    With gzip_copy, the same page also goes to output_file + '.gz' in the same pass."""
+    root = m.get_root()
+    # What Figure.render() does ahead of its template: each child adds its parts to the page
+    for child in root._children.values():
+        child.render()
+    _defer_font_awesome(root)
+    gz_file = output_file + '.gz'
+    with contextlib.ExitStack() as stack:
+        outs = [stack.enter_context(open(output_file, 'w', encoding='utf-8', newline=''))]
+        if gzip_copy:
+            # Precompressed for servers that hand it out as Content-Encoding: gzip
+            outs.append(stack.enter_context(gzip.open(gz_file, 'wt', compresslevel=6, encoding='utf-8', newline='')))
+        else:
+            # A copy left from an earlier run would be served in place of this page
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(gz_file)
+        for chunk in root._template.generate(this=root, kwargs={}):
+            for out in outs:
+                out.write(chunk)
@@ -0,0 +1,98 @@
+"""Route polyline for the map scripts, embedded as an encoded polyline string instead of a JSON coordinate array."""
+import folium
+import numpy as np
+from branca.element import MacroElement, Template
+
+def encode_polyline(track, precision=5):
+    """Encode an (N, 2) sequence of [lat, lon] with Google's encoded polyline algorithm."""
+    # Deltas between rounded absolute values, so rounding errors don't accumulate along the route
+    values = np.rint(np.asarray(track, dtype=np.float64) * 10.0 ** precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=0).ravel()
+    # Zigzag: sign into the lowest bit
+    zz = (deltas << 1) ^ (deltas >> 63)
+    # Split every value into 5-bit chunks, all values at once; only the chunks a value needs are kept
+    n_chunks = 1
+    while (zz >> (5 * n_chunks)).any():
+        n_chunks += 1
+    shifts = 5 * np.arange(n_chunks)
+    rest = zz[:, None] >> shifts
+    needed = rest > 0
+    needed[:, 0] = True
+    # 0x20 marks that more chunks of the same value follow
+    more = np.zeros_like(needed)
+    more[:, :-1] = needed[:, 1:]
+    chars = ((rest & 0x1F) | np.where(more, 0x20, 0)) + 63
+    return chars[needed].astype(np.uint8).tobytes().decode('ascii')
+
+# Largest deviation simplify_track() allows, in degrees of latitude: about 5 m, within GPS noise
+SIMPLIFY_TOLERANCE = 5e-5
+
+def simplify_track(track, tolerance=SIMPLIFY_TOLERANCE):
+    """Ramer-Douglas-Peucker simplification of an (N, 2) [lat, lon] track; returns the kept points in order.
+    Longitudes are scaled by cos(latitude) so the tolerance is a distance along both axes."""
+    track = np.asarray(track, dtype=np.float64)
+    if len(track) < 3:
+        return track
+    xy = track * [1.0, np.cos(np.radians(track[:, 0].mean()))]
+    keep = np.zeros(len(track), dtype=bool)
+    keep[[0, -1]] = True
+    # Explicit stack of (first, last) spans instead of recursion; each span's points are checked at once
+    stack = [(0, len(track) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, chord = xy[first], xy[last] - xy[first]
+        rel = xy[first + 1:last] - start
+        # Distance to the chord segment, not the infinite line through it: a point past either end (an
+        # out-and-back spur) is measured to the nearer end point. A closed loop has a zero-length chord,
+        # so its points are all measured to the shared end point.
+        length2 = chord @ chord
+        t = np.clip(rel @ chord / length2, 0.0, 1.0) if length2 else np.zeros(len(rel))
+        off = rel - t[:, None] * chord
+        dist = np.hypot(off[:, 0], off[:, 1])
+        i = int(dist.argmax())
+        if dist[i] > tolerance:
+            mid = first + 1 + i
+            keep[mid] = True
+            stack.append((first, mid))
+            stack.append((mid, last))
+    return track[keep]
+
+class EncodedPolyLine(MacroElement):
+    """Leaflet polyline decoded in the browser from encode_polyline(); a lighter folium.PolyLine for long tracks.
+    Path options (color, weight, opacity, ...) are passed through to L.polyline."""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.polyline(
+                (function(str, factor) {
+                    var coords = [], lat = 0, lon = 0, i = 0;
+                    function next() {
+                        var b, shift = 0, result = 0;
+                        do {
+                            b = str.charCodeAt(i++) - 63;
+                            result |= (b & 0x1f) << shift;
+                            shift += 5;
+                        } while (b >= 0x20);
+                        return (result & 1) ? ~(result >> 1) : (result >> 1);
+                    }
+                    while (i < str.length) {
+                        lat += next();
+                        lon += next();
+                        coords.push([lat / factor, lon / factor]);
+                    }
+                    return coords;
+                })({{ this.encoded|tojson }}, {{ this.factor }}),
+                {{ this.options|tojson }}
+            ).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, track, popup=None, precision=5, **options):
+        super().__init__()
+        self._name = 'EncodedPolyLine'
+        self.encoded = encode_polyline(track, precision)
+        self.factor = 10 ** precision
+        self.options = options
+        if popup is not None:
+            self.add_child(popup if isinstance(popup, folium.Popup) else folium.Popup(str(popup)))
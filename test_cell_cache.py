@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Checks for the Overpass cell cache in find_amenities_near_route; runs under pytest or on its own."""
+import tempfile
+from types import SimpleNamespace
+
+from find_amenities_near_route import Node, Way, cell_key, load_cells, open_cache, save_cells
+
+def cache_args(cache_dir, **overrides):
+    """The parse_args() fields the cache reads."""
+    return SimpleNamespace(**{'cache_dir': cache_dir, 'no_cache': False, 'cache_ttl': 3600,
+                              'nodes_only': False, 'search_radius': 300, **overrides})
+
+def test_cell_key():
+    args = cache_args(None)
+    # Rounded to the cell, so nearby sample points share an entry
+    assert cell_key(args, 51.50049, -3.19951) == cell_key(args, 51.5, -3.2)
+    assert cell_key(args, 51.5006, -3.2) != cell_key(args, 51.5, -3.2)
+    # Different radius or scope, different results
+    assert cell_key(cache_args(None, search_radius=500), 51.5, -3.2) != cell_key(args, 51.5, -3.2)
+    assert cell_key(cache_args(None, nodes_only=True), 51.5, -3.2) != cell_key(args, 51.5, -3.2)
+
+def test_round_trip():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        args = cache_args(cache_dir)
+        cafe = Node(1, 51.5, -3.2, {'amenity': 'cafe', 'name': 'Caffi'})
+        toilets = Way(2, 51.501, -3.201, {'amenity': 'toilets'})
+        water = Node(3, 51.502, -3.202, {'amenity': 'drinking_water'})
+        here, there = cell_key(args, 51.5, -3.2), cell_key(args, 51.502, -3.202)
+        cells = {here: ([cafe], [toilets]), there: ([cafe, water], [])}
+        conn = open_cache(args)
+        try:
+            save_cells(conn, cells)
+            missing = cell_key(args, 52.0, -3.0)
+            found = load_cells(args, conn, [here, there, missing])
+            assert found == cells
+            # An element in several cells comes back as one object
+            assert found[here][0][0] is found[there][0][0]
+            # Past the TTL, nothing is returned
+            assert load_cells(cache_args(cache_dir, cache_ttl=-1), conn, [here, there]) == {}
+        finally:
+            conn.close()
+
+def test_no_cache():
+    args = cache_args(None, no_cache=True)
+    conn = open_cache(args)
+    assert conn is None
+    save_cells(conn, {cell_key(args, 51.5, -3.2): ([], [])})
+    assert load_cells(args, conn, [cell_key(args, 51.5, -3.2)]) == {}
+
+if __name__ == '__main__':
+    test_cell_key()
+    test_round_trip()
+    test_no_cache()
+    print('ok')
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Checks for gpx_io.parse_description(); runs under pytest or on its own."""
+import random
+import re
+
+import gpx_io
+from find_amenities_near_route import format_wp
+from gpx_io import parse_description
+
+def reference_parse(desc):
+    """parse_description() as it was before the single-pattern version: one search and one sub() per field."""
+    if not desc:
+        return '', None, None, None
+    m_start = re.search(r'Route km:\s*([0-9]+(?:\.[0-9]+)?)', desc)
+    m_rem = re.search(r'Remaining:\s*([0-9]+(?:\.[0-9]+)?)km', desc)
+    m_off = re.search(r'Off route:\s*([0-9]+)m', desc)
+    clean = re.sub(r'\.?\s*Route km:\s*[0-9]+(?:\.[0-9]+)?', '', desc)
+    clean = re.sub(r'\,?\s*Remaining:\s*[0-9]+(?:\.[0-9]+)?km', '', clean)
+    clean = re.sub(r'\,?\s*Off route:\s*[0-9]+m', '', clean)
+    clean = re.sub(r'\.?\s*Website:\s*\S+', '', clean).strip()
+    if clean.endswith('.'):
+        clean = clean[:-1]
+    return (clean,
+            float(m_start.group(1)) if m_start else None,
+            float(m_rem.group(1)) if m_rem else None,
+            int(m_off.group(1)) if m_off else None)
+
+def written_description(desc, website=None):
+    """<desc> text as find_amenities_near_route.py writes it."""
+    tags = {'website': website} if website else None
+    return format_wp(51.5, -3.2, 'Caffi', desc, 12.34, 56.78, 42.4, 'cafe', tags)[4]
+
+# Hand-edited or older descriptions, off the layout find_amenities_near_route.py writes
+IRREGULAR = [
+    'Route km: 3.5',
+    'Off route: 12m. Route km: 3.5, Remaining: 20km',
+    'amenity=cafe, Remaining: 1.5km',
+    'Nice spot. Route km: 7, Remaining: 8.25km, Off route: 9m. Open late',
+    'Route km: 1.0. Route km: 2.0, Remaining: 3.0km, Off route: 4m',
+    'Website: https://example.com. Route km: 1.0, Remaining: 2.0km, Off route: 3m',
+    'Off route: 10 m, Route km: 2.0',
+    'Just a note.',
+    '  Padded text.  ',
+    'Remaining: 4km trailing text',
+    'Multi\nline. Route km: 1.0, Remaining: 2.0km, Off route: 3m',
+]
+
+def test_canonical_layout():
+    for desc, website in [('amenity=cafe', None), ('amenity=cafe', 'https://caffi.example/menu'),
+                          ('', None), ('', 'https://caffi.example/')]:
+        text = written_description(desc, website)
+        # The layout the single anchored pattern is for
+        assert gpx_io._DESC_RE.match(text), text
+        assert parse_description(text) == (desc.replace('amenity=', ''), 12.3, 56.8, 42), text
+        assert parse_description(text) == reference_parse(text), text
+
+def test_fallback_layouts():
+    for text in IRREGULAR:
+        assert parse_description(text) == reference_parse(text), text
+    assert parse_description('Off route: 12m. Route km: 3.5, Remaining: 20km') == ('', 3.5, 20.0, 12)
+    assert parse_description('Just a note.') == ('Just a note', None, None, None)
+
+def test_fallback_random():
+    # Fields, labels without values and plain text in any order, with the separators seen in hand-edited files
+    pieces = ['Route km: 1.5', 'Route km: 2', 'Remaining: 3.25km', 'Remaining: 4km', 'Off route: 12m',
+              'Website: https://a.example/x', 'Nice', 'amenity=cafe', 'text.', 'Route km:', 'Remaining: x', '']
+    rnd = random.Random(0)
+    for _ in range(5000):
+        text = ''.join(rnd.choice(pieces) + rnd.choice(['. ', ', ', ' ', '.\n', '; ', ''])
+                       for _ in range(rnd.randint(1, 7)))
+        assert parse_description(text) == reference_parse(text), text
+
+def test_empty():
+    assert parse_description('') == ('', None, None, None)
+    assert parse_description(None) == ('', None, None, None)
+
+if __name__ == '__main__':
+    test_canonical_layout()
+    test_fallback_layouts()
+    test_fallback_random()
+    test_empty()
+    print('ok')
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Checks for route_polyline.simplify_track(); runs under pytest or on its own."""
+import os
+
+import numpy as np
+
+from gpx_io import read_gpx
+from route_polyline import SIMPLIFY_TOLERANCE, simplify_track
+
+EL_PIRI = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test-gpx-files', 'el_piri_amenities.gpx')
+
+def max_deviation(track, tolerance=SIMPLIFY_TOLERANCE):
+    """Largest distance from a track point to the simplified segment that replaced it, scaled like simplify_track()."""
+    kept = simplify_track(track, tolerance)
+    scale = [1.0, np.cos(np.radians(track[:, 0].mean()))]
+    xy, kept_xy = track * scale, kept * scale
+    # Kept points are track points, in order: each span of the track is replaced by one segment.
+    # Matched in sequence, since a route can pass the same coordinates more than once.
+    idx, i = [], 0
+    for point in kept:
+        while not (track[i] == point).all():
+            i += 1
+        idx.append(i)
+    worst = 0.0
+    for (i, j), (a, b) in zip(zip(idx[:-1], idx[1:]), zip(kept_xy[:-1], kept_xy[1:])):
+        rel, chord = xy[i:j + 1] - a, b - a
+        t = np.clip(rel @ chord / (chord @ chord), 0.0, 1.0) if chord @ chord else np.zeros(len(rel))
+        worst = max(worst, np.hypot(*(rel - t[:, None] * chord).T).max())
+    return worst
+
+def test_spur_survives():
+    # 10 points heading east, then 5 back west along the same line
+    track = np.array([[0.0, i * 1e-3] for i in range(10)] + [[0.0, (9 - i) * 1e-3] for i in range(1, 6)])
+    kept = simplify_track(track)
+    # The turnaround point is the spur's far end
+    assert track[9].tolist() in kept.tolist(), kept
+    assert max_deviation(track) <= SIMPLIFY_TOLERANCE
+
+def test_max_deviation_within_tolerance():
+    track, _ = read_gpx(EL_PIRI)
+    assert len(simplify_track(track)) < len(track)
+    assert max_deviation(track) <= SIMPLIFY_TOLERANCE
+
+if __name__ == '__main__':
+    test_spur_survives()
+    test_max_deviation_within_tolerance()
+    print('ok')
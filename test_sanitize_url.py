@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Checks for find_amenities_near_route.sanitize_url(); runs under pytest or on its own."""
+import random
+import re
+
+import find_amenities_near_route
+from find_amenities_near_route import _CLEAN_URL_RE, sanitize_url
+
+def slow_sanitize_url(url):
+    """sanitize_url() with the already-clean shortcut turned off: always the urlsplit/quote round trip."""
+    fast = find_amenities_near_route._CLEAN_URL_RE
+    find_amenities_near_route._CLEAN_URL_RE = re.compile(r'(?!)')
+    try:
+        return sanitize_url(url)
+    finally:
+        find_amenities_near_route._CLEAN_URL_RE = fast
+
+URLS = [
+    'https://example.com',
+    'https://example.com/',
+    'http://www.caffi.example/menu/today?lang=cy&x=1#top',
+    'https://example.com/a%41b',            # unquote/quote normalises the escape
+    'https://example.com/a%2Fb',
+    'https://example.com/100%',
+    'https://example.com/a;b',
+    'https://example.com/?a=1&amp;b=2',     # entity unescaped on the slow path
+    'https://example.com/page?',            # urlunsplit drops an empty query
+    'https://example.com/page#',
+    'https://example.com/page?#',
+    'https://example.com/page?#frag',
+    'https://example.com/?q=a b',
+    '  https://example.com/padded  ',
+    'example.com/no-scheme',
+    'www.example.com',
+    'https://user@example.com/',
+    'https://example.com:8080/',
+    'https://EXAMPLE.com/Café',
+    "https://example.com/it's(1)*+,=!$@[]~",
+    'ftp://example.com/file',
+]
+
+def test_known_urls():
+    for url in URLS:
+        assert sanitize_url(url) == slow_sanitize_url(url), url
+    # The shortcut is taken for plain URLs, and only for those the round trip leaves as they are
+    assert _CLEAN_URL_RE.match('http://www.caffi.example/menu/today?lang=cy&x=1#top')
+    for url in ('https://example.com/a%41b', 'https://example.com/a;b', 'https://example.com/page?',
+                'https://example.com/page#', 'https://example.com/page?#frag'):
+        assert not _CLEAN_URL_RE.match(url), url
+
+def test_random_urls():
+    # Mostly characters the shortcut accepts, with the ones it must turn away mixed in
+    chars = "abcXYZ019-._~/?#[]@!$&'()*+,=%;: é"
+    rnd = random.Random(0)
+    for _ in range(20000):
+        tail = ''.join(rnd.choice(chars) for _ in range(rnd.randint(0, 16)))
+        url = rnd.choice(['https://', 'http://', '']) + rnd.choice(['example.com', 'a-b.example.org']) + '/' + tail
+        assert sanitize_url(url) == slow_sanitize_url(url), url
+
+def test_empty():
+    assert sanitize_url('') == ('', '')
+    assert sanitize_url(None) == (None, '')
+
+if __name__ == '__main__':
+    test_known_urls()
+    test_random_urls()
+    test_empty()
+    print('ok')
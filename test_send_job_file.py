@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Checks for how app.send_job_file() serves a map with a precompressed copy; runs under pytest or on its own."""
+import contextlib
+import gzip
+import tempfile
+from pathlib import Path
+
+import app as webapp
+
+PAGE = b'<!DOCTYPE html><html><body>map</body></html>'
+
+@contextlib.contextmanager
+def job_client():
+    """Test client over a temporary WORK_DIR holding job 'abc123' with map.html and its map.html.gz copy."""
+    work_dir = webapp.WORK_DIR
+    with tempfile.TemporaryDirectory() as tmp:
+        job_dir = Path(tmp) / 'abc123'
+        job_dir.mkdir()
+        (job_dir / 'map.html').write_bytes(PAGE)
+        (job_dir / 'map.html.gz').write_bytes(gzip.compress(PAGE))
+        webapp.WORK_DIR = Path(tmp)
+        try:
+            yield webapp.app.test_client()
+        finally:
+            webapp.WORK_DIR = work_dir
+
+def get(client, url, accept_encoding=None):
+    headers = {'Accept-Encoding': accept_encoding} if accept_encoding is not None else {}
+    response = client.get(url, headers=headers)
+    body = response.get_data()
+    response.close()
+    return response, body
+
+def test_gzip_accepted():
+    with job_client() as client:
+        response, body = get(client, '/artifact/abc123/map.html', 'gzip, deflate')
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.mimetype == 'text/html'
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert gzip.decompress(body) == PAGE
+
+def test_gzip_refused():
+    with job_client() as client:
+        # Listed, but with quality 0: the client refuses gzip
+        for accept_encoding in ('gzip;q=0', 'identity', ''):
+            response, body = get(client, '/artifact/abc123/map.html', accept_encoding)
+            assert response.status_code == 200, accept_encoding
+            assert 'Content-Encoding' not in response.headers, accept_encoding
+            assert 'Accept-Encoding' in response.headers['Vary'], accept_encoding
+            assert body == PAGE, accept_encoding
+
+def test_download_and_gz_file():
+    with job_client() as client:
+        # Downloads are the plain file, whatever the client accepts
+        response, body = get(client, '/download/abc123/map.html', 'gzip')
+        assert 'Content-Encoding' not in response.headers
+        assert body == PAGE
+        # The copy itself is a .gz file, not the page
+        response, body = get(client, '/artifact/abc123/map.html.gz', 'gzip')
+        assert response.mimetype == 'application/gzip'
+        assert 'Content-Encoding' not in response.headers
+        assert gzip.decompress(body) == PAGE
+
+if __name__ == '__main__':
+    test_gzip_accepted()
+    test_gzip_refused()
+    test_download_and_gz_file()
+    print('ok')
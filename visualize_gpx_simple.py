@@ -1,135 +1,282 @@
 #!/usr/bin/env python3
 import folium
 from folium import plugins
-import re
+from branca.element import Template, MacroElement
 import argparse
+import html
 import os
 
+from gpx_io import read_gpx
+from map_html import UNCLUSTER_ZOOM, add_amenity_groups, print_map_report, save_map
+from route_polyline import SIMPLIFY_TOLERANCE, EncodedPolyLine, simplify_track
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; track_stats falls back to NumPy reductions
+    njit = None
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Visualize GPX route with amenities using Folium (XML-safe)")
     parser.add_argument("gpx_file", help="GPX file with route and amenities")
     parser.add_argument("-o", "--output", default=None,
                        help="Output HTML file (default: input filename with '.html' extension)")
+    parser.add_argument("--cache-dir", default=None,
+                       help="Directory to keep the parsed GPX in, reused while the file is unchanged (default: no cache)")
+    parser.add_argument("--no-simplify", action="store_true",
+                       help="Draw every track point instead of a simplified route line")
+    parser.add_argument("--simplify-tolerance", type=float, default=SIMPLIFY_TOLERANCE,
+                       help="Largest distance the simplified route line may stray from the track, in degrees of latitude (default: %(default)s, about 5 m)")
+    parser.add_argument("--gzip", action="store_true",
+                       help="Also write a gzip-compressed copy of the map next to it (<output>.gz)")
     return parser.parse_args()
 
-def extract_gpx_data_with_regex(gpx_content):
-    """Extract GPX data using regex to avoid XML parsing issues"""
-    
-    # Extract track points
-    track_points = []
-    trkpt_pattern = r'<trkpt lat="([^"]+)" lon="([^"]+)"'
-    for match in re.finditer(trkpt_pattern, gpx_content):
-        lat, lon = float(match.group(1)), float(match.group(2))
-        track_points.append([lat, lon])
-    
-    # Extract waypoints
-    waypoints = []
-    wpt_pattern = r'<wpt lat="([^"]+)" lon="([^"]+)".*?</wpt>'
-    
-    for wpt_match in re.finditer(wpt_pattern, gpx_content, re.DOTALL):
-        lat, lon = float(wpt_match.group(1)), float(wpt_match.group(2))
-        wpt_content = wpt_match.group(0)
-        
-        # Extract name
-        name_match = re.search(r'<name>(.*?)</name>', wpt_content)
-        name = name_match.group(1) if name_match else 'Unnamed'
-        
-        # Extract description
-        desc_match = re.search(r'<desc>(.*?)</desc>', wpt_content, re.DOTALL)
-        description = desc_match.group(1) if desc_match else ''
-        
-        # Extract symbol
-        sym_match = re.search(r'<sym>(.*?)</sym>', wpt_content)
-        symbol = sym_match.group(1) if sym_match else 'Waypoint'
-        
-        # Extract type
-        type_match = re.search(r'<type>(.*?)</type>', wpt_content)
-        amenity_type = type_match.group(1) if type_match else 'Amenity'
-        
-        waypoints.append({
-            'lat': lat,
-            'lon': lon,
-            'name': name,
-            'description': description,
-            'symbol': symbol,
-            'type': amenity_type
-        })
-    
-    return track_points, waypoints
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _track_stats_nb(track):
+        n = track.shape[0]
+        s0, s1 = 0.0, 0.0
+        mn0, mx0, mn1, mx1 = track[0, 0], track[0, 0], track[0, 1], track[0, 1]
+        for i in range(n):
+            lat, lon = track[i, 0], track[i, 1]
+            s0 += lat
+            s1 += lon
+            # min/max rather than if-branches, so the loop stays vectorisable
+            mn0, mx0 = min(mn0, lat), max(mx0, lat)
+            mn1, mx1 = min(mn1, lon), max(mx1, lon)
+        return s0 / n, s1 / n, mn0, mn1, mx0, mx1
+
+def track_stats(track):
+    """(center_lat, center_lon, south, west, north, east) of a non-empty (N, 2) track array."""
+    if njit is not None:
+        # One pass over the coordinates instead of three reductions
+        return _track_stats_nb(track)
+    (c_lat, c_lon), (south, west), (north, east) = track.mean(axis=0), track.min(axis=0), track.max(axis=0)
+    return float(c_lat), float(c_lon), float(south), float(west), float(north), float(east)
+
+# Font Awesome (icon, marker color) by GPX <type>, with a fallback by GPX <sym>
+TYPE_ICONS = {
+    'Cafe': ('star', 'orange'),  # Using 'star' icon which is definitely supported
+    'Restaurant': ('cutlery', 'red'),
+    'Pub/Bar': ('glass', 'darkred'),
+    'Fast Food': ('cutlery', 'pink'),
+    'Toilets': ('male', 'blue'),  # Font Awesome toilet icon alternatives: 'male', 'female', 'transgender'
+    'Water Source': ('tint', 'lightblue'),
+    'Fuel Station': ('car', 'orange'),
+    'Bike Shop': ('bicycle', 'green'),
+}
+SYMBOL_ICONS = {
+    'Restaurant': ('cutlery', 'red'),
+    'Restroom': ('male', 'blue'),  # Updated from 'home' to 'male' for toilets
+    'Water Source': ('tint', 'lightblue'),
+    'Gas Station': ('car', 'orange'),
+    'Bike Trail': ('bicycle', 'green'),
+    'Waypoint': ('info-sign', 'gray')
+}
+DEFAULT_ICON = ('info-sign', 'gray')
+
+# Size in pixels of the grid cells amenity markers are counted in below UNCLUSTER_ZOOM
+CLUSTER_RADIUS = 80
 
 def get_amenity_icon_color(symbol, amenity_type=None):
     """Return appropriate icon and color for different amenity types"""
+    # First check by specific type for more granular icons, then fall back to the symbol
+    return TYPE_ICONS.get(amenity_type) or SYMBOL_ICONS.get(symbol, DEFAULT_ICON)
+
+def build_marker(waypoint):
+    """Marker data (position, icon and escaped popup text) for one waypoint; no folium objects involved"""
+    lat, lon = waypoint.latitude, waypoint.longitude
+    name = waypoint.name or 'Unnamed'
+    description = waypoint.description or ''
+    symbol = waypoint.symbol or 'Waypoint'
+    amenity_type = waypoint.type or 'Amenity'
     
-    # First check by specific type for more granular icons
-    if amenity_type:
-        type_map = {
-            'Cafe': ('star', 'orange'),  # Using 'star' icon which is definitely supported
-            'Restaurant': ('cutlery', 'red'),
-            'Pub/Bar': ('glass', 'darkred'),
-            'Fast Food': ('cutlery', 'pink'),
-            'Toilets': ('male', 'blue'),  # Font Awesome toilet icon alternatives: 'male', 'female', 'transgender'
-            'Water Source': ('tint', 'lightblue'),
-            'Fuel Station': ('car', 'orange'),
-            'Bike Shop': ('bicycle', 'green'),
-        }
-        if amenity_type in type_map:
-            return type_map[amenity_type]
-    
-    # Fallback to symbol-based mapping
-    icon_map = {
-        'Restaurant': ('cutlery', 'red'),
-        'Restroom': ('male', 'blue'),  # Updated from 'home' to 'male' for toilets
-        'Water Source': ('tint', 'lightblue'),
-        'Gas Station': ('car', 'orange'),
-        'Bike Trail': ('bicycle', 'green'),
-        'Waypoint': ('info-sign', 'gray')
+    # Get appropriate icon and color
+    icon_name, color = get_amenity_icon_color(symbol, amenity_type)
+    
+    # Extract website URL if present and make it clickable; the parser has already decoded entities such as &amp;
+    before, sep, after = description.partition('Website:')
+    if sep:
+        website_url = after.strip()
+        display_desc = before.rstrip('. ')
+    else:
+        website_url = None
+        display_desc = description
+    
+    # GPX text is plain text: escaped once for every place it lands in HTML; the popup markup around it
+    # is added in the browser
+    return {
+        'lat': lat,
+        'lon': lon,
+        'icon': icon_name,
+        'color': color,
+        'name': html.escape(name),
+        'desc': html.escape(display_desc),
+        'url': html.escape(website_url) if website_url else '',
+        'type': amenity_type,
     }
-    return icon_map.get(symbol, ('info-sign', 'gray'))
 
-def create_folium_map(gpx_file, output_file):
-    """Create an interactive Folium map from GPX data using regex parsing"""
+# Keeps the amenity markers in and around the current view on their feature groups, sharing one icon
+# per (color, icon) pair. Points are bucketed per type on a grid of CLUSTER_RADIUS-pixel cells, built
+# once per zoom level the first time it is shown; each move only looks up the cells in view, so its cost
+# follows what is on screen rather than the number of waypoints. Below UNCLUSTER_ZOOM a cell's points
+# of one type are shown as a single count marker. A marker is only created the first time it comes
+# into view, and its popup and tooltip the first time they are shown
+AMENITY_MARKERS_JS = """
+{% macro script(this, kwargs) %}
+    (function() {
+        var map = {{ this._parent.get_name() }};
+        var groups = {
+            {%- for amenity_type, group in this.groups.items() %}
+            {{ amenity_type|tojson }}: {{ group.get_name() }},
+            {%- endfor %}
+        };
+        var points = {{ this.markers|tojson }};
+        var types = {{ this.type_labels|tojson }};
+        var RADIUS = {{ this.cluster_radius }}, UNCLUSTER_ZOOM = {{ this.uncluster_zoom }};
+        var icons = {};
+        var layers = {};   // cached markers and count markers, by key
+        var shown = {};    // key -> {layer, group} currently on the map
+        var grids = {};    // zoom -> {type: {"x:y": cell}}
+        // Web Mercator position of each point as a fraction of the world's width
+        var px = new Float64Array(points.length), py = new Float64Array(points.length);
+        function mercX(lon) { return lon / 360 + 0.5; }
+        function mercY(lat) {
+            var s = Math.sin(Math.max(-85.05, Math.min(85.05, lat)) * Math.PI / 180);
+            return 0.5 - Math.log((1 + s) / (1 - s)) / (4 * Math.PI);
+        }
+        points.forEach(function(p, i) { px[i] = mercX(p.lon); py[i] = mercY(p.lat); });
+        function grid(zoom) {
+            if (grids[zoom]) { return grids[zoom]; }
+            var scale = 256 * Math.pow(2, zoom) / RADIUS, cells = {};
+            points.forEach(function(p, i) {
+                var byType = cells[p.type] || (cells[p.type] = {});
+                var key = Math.floor(px[i] * scale) + ':' + Math.floor(py[i] * scale);
+                var cell = byType[key] || (byType[key] = {lat: 0, lon: 0, idx: []});
+                cell.lat += p.lat;
+                cell.lon += p.lon;
+                cell.idx.push(i);
+            });
+            return grids[zoom] = cells;
+        }
+        function popup(p) {
+            return '<div style="min-width: 200px;">'
+                + '<b style="color: #2E4057; font-size: 14px;">' + p.name + '</b><br>'
+                + '<span style="color: #666; font-size: 12px;">Type: ' + types[p.type] + '</span><br>'
+                + '<span style="font-size: 11px;">' + p.desc + '</span>'
+                + (p.url ? '<br><br><a href="' + p.url + '" target="_blank" rel="noopener noreferrer" '
+                    + 'style="color: #1976D2; text-decoration: none; font-weight: bold; font-size: 12px;">'
+                    + '🌐 Visit Website</a>' : '')
+                + '</div>';
+        }
+        function createMarker(p) {
+            var key = p.color + '|' + p.icon;
+            var icon = icons[key] || (icons[key] = L.AwesomeMarkers.icon(
+                {markerColor: p.color, iconColor: 'white', icon: p.icon, prefix: 'glyphicon'}
+            ));
+            return L.marker([p.lat, p.lon], {icon: icon})
+                .bindPopup(function() { return popup(p); }, {maxWidth: 300})
+                .bindTooltip(function() { return p.name + ' (' + types[p.type] + ')'; }, {sticky: true});
+        }
+        function createCount(cell, type, zoom) {
+            var n = cell.idx.length, center = [cell.lat / n, cell.lon / n];
+            var marker = L.marker(center, {icon: L.divIcon({
+                className: '',
+                iconSize: [30, 30],
+                html: '<div style="width:30px;height:30px;border-radius:15px;background:' + points[cell.idx[0]].color
+                    + ';color:#fff;font:bold 12px/30px Arial,sans-serif;text-align:center;'
+                    + 'box-shadow:0 0 0 3px rgba(255,255,255,0.7)">' + n + '</div>'
+            })});
+            marker.bindTooltip(n + ' × ' + types[type], {sticky: true});
+            marker.on('click', function() { map.setView(center, Math.min(zoom + 2, UNCLUSTER_ZOOM)); });
+            return marker;
+        }
+        function update() {
+            var zoom = Math.round(map.getZoom()), cells = grid(zoom);
+            var scale = 256 * Math.pow(2, zoom) / RADIUS, last = Math.ceil(scale) - 1;
+            // Padded, so markers just past the edges are already there while panning
+            var bounds = map.getBounds().pad(0.25);
+            var x0 = Math.max(0, Math.floor(mercX(bounds.getWest()) * scale));
+            var x1 = Math.min(last, Math.floor(mercX(bounds.getEast()) * scale));
+            var y0 = Math.max(0, Math.floor(mercY(bounds.getNorth()) * scale));
+            var y1 = Math.min(last, Math.floor(mercY(bounds.getSouth()) * scale));
+            var next = {};
+            function show(key, type, make) {
+                if (shown[key]) {
+                    next[key] = shown[key];
+                    return;
+                }
+                next[key] = {layer: layers[key] || (layers[key] = make()), group: groups[type]};
+                next[key].group.addLayer(next[key].layer);
+            }
+            Object.keys(cells).forEach(function(type) {
+                var byType = cells[type];
+                for (var x = x0; x <= x1; x++) {
+                    for (var y = y0; y <= y1; y++) {
+                        var cell = byType[x + ':' + y];
+                        if (!cell) { continue; }
+                        if (zoom < UNCLUSTER_ZOOM && cell.idx.length > 1) {
+                            show(zoom + '/' + type + '/' + x + ':' + y, type, function() { return createCount(cell, type, zoom); });
+                        } else {
+                            cell.idx.forEach(function(i) {
+                                show(i, type, function() { return createMarker(points[i]); });
+                            });
+                        }
+                    }
+                }
+            });
+            Object.keys(shown).forEach(function(key) {
+                if (!next[key]) { shown[key].group.removeLayer(shown[key].layer); }
+            });
+            shown = next;
+        }
+        map.whenReady(update);
+        map.on('moveend', update);
+    })();
+{% endmacro %}
+"""
+
+def create_folium_map(gpx_file, output_file, cache_dir=None, simplify=True, gzip_copy=False, simplify_tolerance=SIMPLIFY_TOLERANCE):
+    """Create an interactive Folium map from GPX data"""
     
     print(f"Reading GPX file: {gpx_file}")
     
-    # Read GPX file as text
-    with open(gpx_file, 'r', encoding='utf-8') as f:
-        gpx_content = f.read()
-    
-    # Extract data using regex
-    track_points, waypoints = extract_gpx_data_with_regex(gpx_content)
+    track, waypoints = read_gpx(gpx_file, cache_dir)
     
-    print(f"Found {len(track_points)} track points and {len(waypoints)} waypoints")
+    print(f"Found {len(track)} track points and {len(waypoints)} waypoints")
     
-    if not track_points:
+    if not len(track):
         print("No track points found in GPX file")
         return
     
-    # Calculate map center
-    center_lat = sum(p[0] for p in track_points) / len(track_points)
-    center_lon = sum(p[1] for p in track_points) / len(track_points)
+    # Map center and the route's bounding box
+    center_lat, center_lon, south, west, north, east = track_stats(track)
     
-    # Create map
+    # Create map; the route line is drawn on one canvas rather than as an SVG path
     m = folium.Map(
         location=[center_lat, center_lon],
         zoom_start=12,
-        tiles='OpenStreetMap'
+        tiles='OpenStreetMap',
+        prefer_canvas=True
     )
     
-    # Add the route as a polyline
-    route_line = folium.PolyLine(
-        track_points,
+    # Add the route as a polyline, shipped as an encoded string (a few bytes per point); points within
+    # the simplify tolerance of the simplified line add bytes but nothing visible
+    route_line = EncodedPolyLine(
+        simplify_track(track, simplify_tolerance) if simplify else track,
         color='blue',
         weight=4,
         opacity=0.8,
         popup='GPX Route'
     )
     route_line.add_to(m)
+    # Open on the whole route rather than a fixed zoom around its center
+    m.fit_bounds([[south, west], [north, east]])
     
     # Add start and end markers
-    if track_points:
+    if len(track):
         # Start marker (green)
         folium.Marker(
-            track_points[0],
+            track[0].tolist(),
             popup='Start',
             tooltip='Route Start',
             icon=folium.Icon(color='green', icon='play')
@@ -137,69 +284,27 @@ def create_folium_map(gpx_file, output_file):
         
         # End marker (red)
         folium.Marker(
-            track_points[-1],
+            track[-1].tolist(),
             popup='End',
             tooltip='Route End',
             icon=folium.Icon(color='red', icon='stop')
         ).add_to(m)
     
-    # Create feature groups for different amenity types
-    amenity_groups = {}
+    # Create feature groups for different amenity types; their markers are built in the browser,
+    # only for the part of the route in view, and counted per grid cell until UNCLUSTER_ZOOM
+    amenity_markers = [build_marker(waypoint) for waypoint in waypoints]
+    # Type counts are reused for the statistics
+    amenity_groups, type_order = add_amenity_groups(m, (marker['type'] for marker in amenity_markers))
     
-    for waypoint in waypoints:
-        lat, lon = waypoint['lat'], waypoint['lon']
-        name = waypoint['name']
-        description = waypoint['description']
-        symbol = waypoint['symbol']
-        amenity_type = waypoint['type']
-        
-        # Get appropriate icon and color
-        icon_name, color = get_amenity_icon_color(symbol, amenity_type)
-        
-        # Clean up description for display
-        clean_desc = description.replace('&amp;', '&')
-        
-        # Extract website URL if present and make it clickable
-        website_url = None
-        display_desc = clean_desc
-        
-        if 'Website:' in clean_desc:
-            parts = clean_desc.split('Website:', 1)
-            if len(parts) == 2:
-                website_url = parts[1].strip()
-                display_desc = parts[0].rstrip('. ')
-                
-        # Create popup content with clickable website link
-        popup_content = f"""
-        <div style="min-width: 200px;">
-        <b style="color: #2E4057; font-size: 14px;">{name}</b><br>
-        <span style="color: #666; font-size: 12px;">Type: {amenity_type}</span><br>
-        <span style="font-size: 11px;">{display_desc}</span>
-        """
-        
-        if website_url:
-            popup_content += f'''<br><br>
-            <a href="{website_url}" target="_blank" rel="noopener noreferrer" 
-               style="color: #1976D2; text-decoration: none; font-weight: bold; font-size: 12px;">
-               🌐 Visit Website
-            </a>'''
-        
-        popup_content += "</div>"
-        
-        # Create marker
-        marker = folium.Marker(
-            [lat, lon],
-            popup=folium.Popup(popup_content, max_width=300),
-            tooltip=f"{name} ({amenity_type})",
-            icon=folium.Icon(color=color, icon=icon_name)
-        )
-        
-        # Group markers by type for layer control
-        if amenity_type not in amenity_groups:
-            amenity_groups[amenity_type] = folium.FeatureGroup(name=amenity_type)
-            amenity_groups[amenity_type].add_to(m)
-        
-        marker.add_to(amenity_groups[amenity_type])
+    # One JSON array of marker data instead of a Marker, Icon and Popup rendered per waypoint
+    markers_macro = MacroElement()
+    markers_macro._template = Template(AMENITY_MARKERS_JS)
+    markers_macro.groups = amenity_groups
+    markers_macro.markers = amenity_markers
+    markers_macro.type_labels = {amenity_type: html.escape(amenity_type) for amenity_type in amenity_groups}
+    markers_macro.cluster_radius = CLUSTER_RADIUS
+    markers_macro.uncluster_zoom = UNCLUSTER_ZOOM
+    markers_macro.add_to(m)
     
     # Add layer control to toggle amenity types
     folium.LayerControl().add_to(m)
@@ -208,18 +313,8 @@ def create_folium_map(gpx_file, output_file):
     plugins.Fullscreen().add_to(m)
     
     # Save map
-    m.save(output_file)
-    print(f"Interactive map saved to: {output_file}")
-    print(f"Open in browser: file://{os.path.abspath(output_file)}")
-    
-    # Print statistics
-    print(f"\nMap Statistics:")
-    print(f"- Route points: {len(track_points)}")
-    print(f"- Waypoints: {len(waypoints)}")
-    print(f"- Amenity types: {len(amenity_groups)}")
-    for amenity_type in amenity_groups.keys():
-        count = len([wp for wp in waypoints if wp['type'] == amenity_type])
-        print(f"  - {amenity_type}: {count}")
+    save_map(m, output_file, gzip_copy)
+    print_map_report(output_file, len(track), len(waypoints), type_order)
 
 def main():
     args = parse_args()
@@ -229,7 +324,8 @@ def main():
         base_name = os.path.splitext(args.gpx_file)[0]
         args.output = f"{base_name}_map.html"
     
-    create_folium_map(args.gpx_file, args.output)
+    create_folium_map(args.gpx_file, args.output, args.cache_dir, simplify=not args.no_simplify, gzip_copy=args.gzip,
+                      simplify_tolerance=args.simplify_tolerance)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
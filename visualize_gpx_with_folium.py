@@ -1,83 +1,243 @@
 #!/usr/bin/env python3
-import gpxpy
 import folium
 import argparse
+from html import escape
+import json
 import os
 from folium import plugins
 from branca.element import Template, MacroElement
+from folium.elements import ElementAddToElement
 from folium import Element
-import re
-import string
 
-def parse_args():
+from gpx_io import parse_description, read_gpx, route_distances
+from map_html import CLUSTER_THRESHOLD, LEGEND_TEMPLATE, add_amenity_groups, amenity_cluster, compact_markup, print_map_report, save_map
+from route_polyline import SIMPLIFY_TOLERANCE, EncodedPolyLine, simplify_track
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Visualize GPX route with amenities using Folium")
     parser.add_argument("gpx_file", help="GPX file with route and amenities")
     parser.add_argument("-o", "--output", default=None,
                        help="Output HTML file (default: input filename with '.html' extension)")
-    return parser.parse_args()
+    parser.add_argument("--cache-dir", default=None,
+                       help="Directory to keep the parsed GPX in, reused while the file is unchanged (default: no cache)")
+    parser.add_argument("--no-simplify", action="store_true",
+                       help="Draw every track point instead of a simplified route line")
+    parser.add_argument("--simplify-tolerance", type=float, default=SIMPLIFY_TOLERANCE,
+                       help="Largest distance the simplified route line may stray from the track, in degrees of latitude (default: %(default)s, about 5 m)")
+    parser.add_argument("--gzip", action="store_true",
+                       help="Also write a gzip-compressed copy of the map next to it (<output>.gz)")
+    return parser.parse_args(argv)
+
+# Font Awesome (icon, marker color) by GPX <type>, with a fallback by GPX <sym>
+TYPE_ICONS = {
+    'Cafe': ('coffee', 'orange'),
+    'Restaurant': ('cutlery', 'red'),
+    'Pub/Bar': ('beer', 'darkred'),
+    'Fast Food': ('cutlery', 'pink'),
+    'Toilets': ('male', 'blue'),
+    'Water Source': ('tint', 'lightblue'),
+    'Fuel Station': ('car', 'darkblue'),
+    'Bike Shop': ('bicycle', 'green'),
+}
+SYMBOL_ICONS = {
+    'Restaurant': ('cutlery', 'red'),
+    'Restroom': ('male', 'blue'),
+    'Water Source': ('tint', 'lightblue'),
+    'Gas Station': ('car', 'darkblue'),
+    'Bike Trail': ('bicycle', 'green'),
+    'Waypoint': ('info-circle', 'gray'),
+}
+DEFAULT_ICON = ('info-circle', 'gray')
 
 def get_amenity_icon_color(amenity_type, symbol):
     """Return appropriate Font Awesome icon name and color for amenity types"""
+    # Prefer type-based mapping, then the GPX symbol
+    return TYPE_ICONS.get(amenity_type) or SYMBOL_ICONS.get(symbol, DEFAULT_ICON)
+
+class WaypointRegistry(MacroElement):
+    """Publishes each amenity marker and its group as window._wptRegistry[marker name] for the toggle control,
+    and binds each marker's popup and tooltip, put together from its popup row the first time they are shown.
+    entries are (marker, group, popup row) with the row [name, type, from km, remaining km, off route m,
+    description, link href, link text]; text is already escaped, distances are null when unknown."""
+    _template = Template('''
+        {% macro script(this, kwargs) %}
+            window._wptRegistry = {
+                {%- for marker, group, _ in this.entries %}
+                {{ marker.get_name()|tojson }}: {marker: {{ marker.get_name() }}, cluster: {{ group.get_name() }}},
+                {%- endfor %}
+            };
+            (function(registry) {
+                function popup(p) {
+                    var dist = [];
+                    if (p[2] !== null) { dist.push("From start: " + p[2].toFixed(1) + " km"); }
+                    if (p[3] !== null) { dist.push("Remaining: " + p[3].toFixed(1) + " km"); }
+                    if (p[4] !== null) { dist.push("Off route: " + p[4] + " m"); }
+                    return "<b>" + p[0] + "</b><br>Type: " + p[1]
+                        + (dist.length ? '<div style="margin-top:4px;color:#333">' + dist.join("<br>") + "</div>" : "")
+                        + (p[5] ? "<br><em>" + p[5] + "</em>" : "")
+                        + (p[6] ? '<br>Website: <a href="' + p[6] + '" target="_blank" rel="noopener">' + p[7] + "</a>" : "");
+                }
+                {{ this.popups|tojson }}.forEach(function(entry) {
+                    var p = entry[1];
+                    registry[entry[0]].marker
+                        .bindPopup(function() { return popup(p); }, {maxWidth: 300})
+                        .bindTooltip(function() { return p[0] + " (" + p[1] + ")"; }, {sticky: true});
+                });
+            })(window._wptRegistry);
+        {% endmacro %}
+    ''')
+
+    def __init__(self, entries):
+        super().__init__()
+        self._name = 'WaypointRegistry'
+        self.entries = entries
+        self.popups = [[marker.get_name(), row] for marker, _, row in entries]
+
+# Per-waypoint checkbox control; this.map_var and this.meta_json are set per map
+WAYPOINT_TOGGLE_TEMPLATE = Template(compact_markup("""
+{% macro html(this, kwargs) %}
+<style>
+    .wpt-toggle-control {
+        background: rgba(255,255,255,0.95);
+        padding: 8px;
+        border-radius: 4px;
+        box-shadow: 0 1px 4px rgba(0,0,0,0.3);
+        max-height: 240px;
+        overflow: auto;
+        font: 12px/1.2 Arial, sans-serif;
+    }
+    .wpt-toggle-control h4 { margin: 0 0 6px 0; font-size: 13px; }
+    .wpt-toggle-actions { margin-bottom: 6px; }
+    .wpt-toggle-actions button { margin-right: 6px; }
+    .wpt-item { white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }
+</style>
+<script>
+(function() {
+    // Safely resolve the map object by name; avoid referencing the variable before it exists
+    var mapName = {{ this.map_var|tojson }};
+    function getMap() {
+        try { return window[mapName]; } catch (e) { return null; }
+    }
+    var map = getMap();
+    var meta = {{ this.meta_json }};
+    if (!meta || !meta.length) return;
+
+    function build() {
+        window._wptHidden = window._wptHidden || new Set();
+
+        // Control UI
+        var Control = L.Control.extend({
+            options: { position: 'topleft' },
+            onAdd: function(map) {
+                var container = L.DomUtil.create('div', 'leaflet-control wpt-toggle-control');
+                var title = L.DomUtil.create('h4', '', container); title.textContent = 'Waypoints';
+                var actions = L.DomUtil.create('div', 'wpt-toggle-actions', container);
+                var btnAll = L.DomUtil.create('button', '', actions); btnAll.type='button'; btnAll.textContent='All';
+                var btnNone = L.DomUtil.create('button', '', actions); btnNone.type='button'; btnNone.textContent='None';
+
+                var list = L.DomUtil.create('div', '', container);
 
-    # Prefer type-based mapping
-    if amenity_type:
-        type_map = {
-            'Cafe': ('coffee', 'orange'),
-            'Restaurant': ('cutlery', 'red'),
-            'Pub/Bar': ('beer', 'darkred'),
-            'Fast Food': ('cutlery', 'pink'),
-            'Toilets': ('male', 'blue'),
-            'Water Source': ('tint', 'lightblue'),
-            'Fuel Station': ('car', 'darkblue'),
-            'Bike Shop': ('bicycle', 'green'),
+                function setCheckedAll(flag) {
+                    var inputs = list.querySelectorAll('input[type=checkbox]');
+                    inputs.forEach(function(cb) {
+                        if (cb.checked !== flag) { cb.checked = flag; toggleOne(cb.dataset.id, flag); }
+                    });
+                }
+
+                btnAll.onclick = function(e) { setCheckedAll(true); };
+                btnNone.onclick = function(e) { setCheckedAll(false); };
+
+                meta.forEach(function(e, idx) {
+                    var row = L.DomUtil.create('div', 'wpt-item', list);
+                    var id = e[0];
+                    var cb = L.DomUtil.create('input', '', row); cb.type='checkbox'; cb.checked = !window._wptHidden.has(id); cb.dataset.id = id; cb.id = 'wpt_' + idx;
+                    var label = L.DomUtil.create('label', '', row); label.htmlFor = cb.id; label.textContent = ' ' + e[1];
+                });
+                // One listener for the whole list rather than one per checkbox
+                list.addEventListener('change', function(ev) {
+                    var cb = ev.target;
+                    if (cb.dataset && cb.dataset.id) { toggleOne(cb.dataset.id, cb.checked); }
+                });
+
+                L.DomEvent.disableClickPropagation(container);
+                return container;
+            }
+        });
+
+        function toggleOne(id, visible) {
+            var rec = window._wptRegistry[id]; if (!rec || !rec.marker) return;
+            var mk = rec.marker;
+            var cl = rec.cluster;
+            if (visible) {
+                window._wptHidden.delete(id);
+                try { if (cl) cl.addLayer(mk); else map.addLayer(mk); } catch(err) {}
+            } else {
+                window._wptHidden.add(id);
+                try { if (cl) cl.removeLayer(mk); else map.removeLayer(mk); } catch(err) {}
+            }
         }
-        if amenity_type in type_map:
-            return type_map[amenity_type]
 
-    # Fallback based on GPX symbol
-    icon_map = {
-        'Restaurant': ('cutlery', 'red'),
-        'Restroom': ('male', 'blue'),
-        'Water Source': ('tint', 'lightblue'),
-        'Gas Station': ('car', 'darkblue'),
-        'Bike Trail': ('bicycle', 'green'),
-        'Waypoint': ('info-circle', 'gray'),
+        function reapplyHidden() {
+            window._wptHidden.forEach(function(id) {
+                var rec = window._wptRegistry[id]; if (!rec || !rec.marker) return;
+                try { if (rec.cluster) { rec.cluster.removeLayer(rec.marker); } else if (map.hasLayer(rec.marker)) { map.removeLayer(rec.marker); } } catch(err){}
+            });
+        }
+
+        // layeradd fires once per layer, so a burst of additions is handled in one pass on the next frame
+        var reapplyPending = false;
+        function scheduleReapply() {
+            if (reapplyPending || !window._wptHidden.size) return;
+            reapplyPending = true;
+            requestAnimationFrame(function() { reapplyPending = false; reapplyHidden(); });
+        }
+        map.on('overlayadd layeradd', scheduleReapply);
+
+        new Control().addTo(map);
+    }
+
+    function start() {
+        // The map script, registry included (WaypointRegistry), has run by the time the document is parsed
+        if (!map) { map = getMap(); }
+        if (!!map && window._wptRegistry) { map.whenReady(build); }
     }
-    return icon_map.get(symbol, ('info-circle', 'gray'))
 
-def create_folium_map(gpx_file, output_file):
+    if (document.readyState === "loading") {
+        document.addEventListener("DOMContentLoaded", start);
+    } else {
+        start();
+    }
+})();
+</script>
+{% endmacro %}
+"""))
+
+def create_folium_map(gpx_file, output_file, cache_dir=None, simplify=True, gzip_copy=False, simplify_tolerance=SIMPLIFY_TOLERANCE):
     """Create an interactive Folium map from GPX data"""
     
-    # Parse GPX file
-    with open(gpx_file, 'r') as f:
-        gpx = gpxpy.parse(f)
+    # Parse GPX file: an (N, 2) track array and lightweight waypoint records
+    track, waypoints = read_gpx(gpx_file, cache_dir)
     
-    # Extract track points
-    track_points = []
-    for track in gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                track_points.append([point.latitude, point.longitude])
-    
-    if not track_points:
+    if not len(track):
         print("No track points found in GPX file")
         return
     
     # Calculate map center
-    center_lat = sum(p[0] for p in track_points) / len(track_points)
-    center_lon = sum(p[1] for p in track_points) / len(track_points)
+    center_lat, center_lon = track.mean(axis=0).tolist()
     
-    # Create map
+    # Create map; vector layers (the route and the amenity circles) all draw on one canvas
     m = folium.Map(
         location=[center_lat, center_lon],
         zoom_start=12,
-        tiles='OpenStreetMap'
+        tiles='OpenStreetMap',
+        prefer_canvas=True
     )
     map_var = m.get_name()
     
-    # Add the route as a polyline
-    route_line = folium.PolyLine(
-        track_points,
+    # Add the route as a polyline, shipped as an encoded string (a few bytes per point); points within
+    # the simplify tolerance of the simplified line add bytes but nothing visible
+    route_line = EncodedPolyLine(
+        simplify_track(track, simplify_tolerance) if simplify else track,
         color='blue',
         weight=4,
         opacity=0.8,
@@ -86,10 +246,10 @@ def create_folium_map(gpx_file, output_file):
     route_line.add_to(m)
     
     # Add start and end markers
-    if track_points:
+    if len(track):
         # Start marker (green)
         folium.Marker(
-            track_points[0],
+            track[0].tolist(),
             popup='Start',
             tooltip='Route Start',
             icon=folium.Icon(color='green', icon='play')
@@ -97,110 +257,72 @@ def create_folium_map(gpx_file, output_file):
         
         # End marker (red)
         folium.Marker(
-            track_points[-1],
+            track[-1].tolist(),
             popup='End',
             tooltip='Route End',
             icon=folium.Icon(color='red', icon='stop')
         ).add_to(m)
     
     # Add waypoints (amenities)
-    amenity_groups = {}
     marker_meta = []  # collect marker JS ids and labels for the toggle control
-    use_cluster = len(gpx.waypoints) > 50
-    marker_cluster = None
-    if use_cluster:
-        marker_cluster = plugins.MarkerCluster(name="Amenities").add_to(m)
+    registry_entries = []  # (marker, group, popup row) for WaypointRegistry
+    marker_cluster = amenity_cluster(m) if len(waypoints) > CLUSTER_THRESHOLD else None
+    # Type counts are reused for the statistics
+    amenity_groups, type_order = add_amenity_groups(m, (waypoint.type or 'Amenity' for waypoint in waypoints), marker_cluster)
     
-    def parse_description(desc: str):
-        """Extract distance fields and return (clean_desc, from_km, remain_km, off_m)."""
-        if not desc:
-            return '', None, None, None
-
-        # Patterns for distances
-        m_start = re.search(r"Route km:\s*([0-9]+(?:\.[0-9]+)?)", desc)
-        m_rem = re.search(r"Remaining:\s*([0-9]+(?:\.[0-9]+)?)km", desc)
-        m_off = re.search(r"Off route:\s*([0-9]+)m", desc)
-
-        start_km = float(m_start.group(1)) if m_start else None
-        remain_km = float(m_rem.group(1)) if m_rem else None
-        off_m = int(m_off.group(1)) if m_off else None
-
-        # Remove matched parts and any inline Website text from description
-        clean = re.sub(r"\.?\s*Route km:\s*[0-9]+(?:\.[0-9]+)?", "", desc)
-        clean = re.sub(r"\,?\s*Remaining:\s*[0-9]+(?:\.[0-9]+)?km", "", clean)
-        clean = re.sub(r"\,?\s*Off route:\s*[0-9]+m", "", clean)
-        clean = re.sub(r"\.?\s*Website:\s*\S+", "", clean)
-        clean = clean.strip()
-        if clean.endswith('.'):
-            clean = clean[:-1]
-        return clean, start_km, remain_km, off_m
-
-    for waypoint in gpx.waypoints:
+    for waypoint in waypoints:
         lat, lon = waypoint.latitude, waypoint.longitude
         name = waypoint.name or 'Unnamed'
         description = waypoint.description or ''
-        symbol = waypoint.symbol or 'Waypoint'
         amenity_type = waypoint.type or 'Amenity'
-        
-        # Get appropriate icon and color
-        icon_name, color = get_amenity_icon_color(amenity_type, symbol)
-
-        # Include clickable website link if present in GPX
-        link_html = ""
-        if getattr(waypoint, 'link', None):
-            link_text = getattr(waypoint, 'link_text', None) or getattr(waypoint, 'link', '')
-            link_href = getattr(waypoint, 'link', '')
-            link_html = f"<br>Website: <a href=\"{link_href}\" target=\"_blank\" rel=\"noopener\">{link_text}</a>"
-
-        # Parse distances from description and build a neat section
-        clean_desc, start_km, remain_km, off_m = parse_description(description)
-        dist_lines = []
-        if start_km is not None:
-            dist_lines.append(f"From start: {start_km:.1f} km")
-        if remain_km is not None:
-            dist_lines.append(f"Remaining: {remain_km:.1f} km")
-        if off_m is not None:
-            dist_lines.append(f"Off route: {off_m} m")
-        dist_html = "<br>".join(dist_lines)
-
-        desc_html = f"<br><em>{clean_desc}</em>" if clean_desc else ""
-        distances_block = f"<div style=\"margin-top:4px;color:#333\">{dist_html}</div>" if dist_html else ""
-        popup_content = f"""
-        <b>{name}</b><br>
-        Type: {amenity_type}
-        {distances_block}
-        {desc_html}
-        {link_html}
-        """
-
-        # Create marker
-        marker = folium.Marker(
+        _, color = get_amenity_icon_color(amenity_type, waypoint.symbol or 'Waypoint')
+        # GPX text is plain text: escaped once for every place it lands in HTML
+        name_e, type_e = escape(name), escape(amenity_type)
+        label = f"{name} ({amenity_type})"
+
+        # Distances from the route extension (older files: parsed from the description)
+        distances = route_distances(waypoint)
+        if distances is not None:
+            clean_desc = waypoint.comment or ''
+            start_km, remain_km, off_m = distances
+        else:
+            clean_desc, start_km, remain_km, off_m = parse_description(description)
+        # Include clickable website link if present in GPX; escape() also quotes '"', so a URL can't end
+        # the href attribute early
+        link_href = waypoint.link
+        link_e = (escape(link_href), escape(waypoint.link_text or link_href)) if link_href else ('', '')
+        popup_row = [
+            name_e, type_e,
+            None if start_km is None else round(start_km, 1),
+            None if remain_km is None else round(remain_km, 1),
+            off_m,
+            escape(clean_desc),
+            *link_e,
+        ]
+
+        # Create marker: a circle in the type's legend color, drawn on the map canvas
+        # rather than an icon element of its own
+        marker = folium.CircleMarker(
             [lat, lon],
-            popup=folium.Popup(popup_content, max_width=300),
-            tooltip=f"{name} ({amenity_type})",
-            icon=folium.Icon(color=color, icon=icon_name, prefix='fa')
+            radius=6,
+            color=color,
+            fill=True,
+            fill_opacity=0.9,
         )
         
         # Group markers by type for layer control
-        if amenity_type not in amenity_groups:
-            if use_cluster and marker_cluster is not None:
-                group = plugins.FeatureGroupSubGroup(marker_cluster, name=amenity_type)
-            else:
-                group = folium.FeatureGroup(name=amenity_type)
-            amenity_groups[amenity_type] = group
-            group.add_to(m)
-
         group = amenity_groups[amenity_type]
         marker.add_to(group)
-        # Record marker meta for interactive toggle
-        try:
-            marker_meta.append({
-                "id": marker.get_name(),
-                "label": f"{name} ({amenity_type})",
-                "cluster": group.get_name()
-            })
-        except Exception:
-            pass
+        # Record marker meta for interactive toggle: [id, label] pairs rather than objects repeating the keys;
+        # the label is shown via textContent, so left unescaped
+        marker_meta.append((marker.get_name(), label))
+        registry_entries.append((marker, group, popup_row))
+    
+    if marker_cluster is not None:
+        # All subgroups are populated by now: one bulk addLayers over every amenity marker
+        m.add_child(ElementAddToElement(marker_cluster.get_name(), m.get_name()))
+    # After every marker in the map script, so the registry is complete once it exists
+    WaypointRegistry(registry_entries).add_to(m)
     
     # Build compact legend referencing the amenity types present on this map
     legend_items = []
@@ -218,185 +340,12 @@ def create_folium_map(gpx_file, output_file):
         legend_entries_html = "".join(
             f'<label class="legend-item"><input type="checkbox" data-layer="{item["layer"]}" checked>'
             f'<span class="legend-swatch" style="background:{item["color"]};"></span>'
-            f'<span class="legend-label"><i class="fa fa-{item["icon"]}"></i> {item["type"]}</span>'
+            f'<span class="legend-label"><i class="fa fa-{item["icon"]}"></i> {escape(item["type"])}</span>'
             '</label>'
             for item in legend_items
         )
 
-        legend_template_str = string.Template("""
-{% macro html(this, kwargs) %}
-<style>
-    .map-legend {
-        position: absolute;
-        bottom: 20px;
-        right: 20px;
-        z-index: 9999;
-        background: rgba(255, 255, 255, 0.95);
-        padding: 10px 12px;
-        border-radius: 6px;
-        box-shadow: 0 1px 4px rgba(0,0,0,0.25);
-        font: 12px/1.3 Arial, sans-serif;
-        min-width: 180px;
-    }
-    .map-legend .legend-header {
-        display: flex;
-        align-items: center;
-        justify-content: space-between;
-        margin-bottom: 6px;
-    }
-    .map-legend .legend-header h4 {
-        margin: 0;
-        font-size: 13px;
-        font-weight: 600;
-        color: #1f2329;
-    }
-    .map-legend .legend-collapse-btn {
-        border: 1px solid #bbb;
-        background: #f6f8fa;
-        padding: 0 6px;
-        cursor: pointer;
-        border-radius: 3px;
-        font-size: 13px;
-        line-height: 1.4;
-    }
-    .map-legend .legend-controls {
-        display: flex;
-        gap: 6px;
-        margin-bottom: 6px;
-    }
-    .map-legend .legend-btn {
-        border: 1px solid #bbb;
-        background: #f6f8fa;
-        padding: 2px 6px;
-        cursor: pointer;
-        border-radius: 3px;
-        font-size: 11px;
-        line-height: 1.2;
-    }
-    .map-legend .legend-btn:focus,
-    .map-legend .legend-collapse-btn:focus {
-        outline: 2px solid #0969da;
-        outline-offset: 1px;
-    }
-    .map-legend .legend-body {
-        display: flex;
-        flex-direction: column;
-        gap: 4px;
-    }
-    .map-legend .legend-item {
-        display: flex;
-        align-items: center;
-        gap: 6px;
-        color: #333;
-    }
-    .map-legend .legend-item input {
-        margin: 0;
-    }
-    .map-legend .legend-swatch {
-        display: inline-block;
-        width: 12px;
-        height: 12px;
-        border-radius: 3px;
-        box-shadow: inset 0 0 0 1px rgba(0,0,0,0.2);
-    }
-    .map-legend .legend-label i {
-        margin-right: 4px;
-        color: #555;
-    }
-    .map-legend.collapsed .legend-controls,
-    .map-legend.collapsed .legend-body {
-        display: none;
-    }
-</style>
-<div class="map-legend" id="amenity-legend" data-enhanced="false">
-    <div class="legend-header">
-        <h4>Amenities</h4>
-        <button type="button" class="legend-collapse-btn" aria-expanded="true" title="Collapse legend">-</button>
-    </div>
-    <div class="legend-controls">
-        <button type="button" class="legend-btn legend-btn-all">All</button>
-        <button type="button" class="legend-btn legend-btn-none">None</button>
-    </div>
-    <div class="legend-body">
-        $legend_entries_html
-    </div>
-</div>
-<script>
-(function() {
-    var mapName = "$map_var";
-    function getMap() {
-        try { return window[mapName]; } catch (err) { return null; }
-    }
-    function setup() {
-        var map = getMap();
-        var legend = document.getElementById("amenity-legend");
-        if (!map || !legend) {
-            setTimeout(setup, 120);
-            return;
-        }
-        if (legend.dataset.enhanced === "true") {
-            return;
-        }
-        legend.dataset.enhanced = "true";
-        var toggles = Array.prototype.slice.call(legend.querySelectorAll('input[type="checkbox"]'));
-        function getLayer(name) {
-            try { return window[name]; } catch (err) { return null; }
-        }
-        function setLayer(name, show) {
-            var layer = getLayer(name);
-            if (!layer) { return; }
-            if (show) {
-                if (!map.hasLayer(layer)) { map.addLayer(layer); }
-            } else {
-                if (map.hasLayer(layer)) { map.removeLayer(layer); }
-            }
-        }
-        toggles.forEach(function(cb) {
-            cb.addEventListener("change", function() {
-                setLayer(cb.dataset.layer, cb.checked);
-            });
-        });
-        function setAll(flag) {
-            toggles.forEach(function(cb) {
-                if (cb.checked !== flag) { cb.checked = flag; }
-                setLayer(cb.dataset.layer, flag);
-            });
-        }
-        var btnAll = legend.querySelector(".legend-btn-all");
-        if (btnAll) {
-            btnAll.addEventListener("click", function(e) {
-                e.preventDefault();
-                setAll(true);
-            });
-        }
-        var btnNone = legend.querySelector(".legend-btn-none");
-        if (btnNone) {
-            btnNone.addEventListener("click", function(e) {
-                e.preventDefault();
-                setAll(false);
-            });
-        }
-        var collapseBtn = legend.querySelector(".legend-collapse-btn");
-        if (collapseBtn) {
-            collapseBtn.addEventListener("click", function(e) {
-                e.preventDefault();
-                var collapsed = legend.classList.toggle("collapsed");
-                collapseBtn.textContent = collapsed ? "+" : "-";
-                collapseBtn.setAttribute("aria-expanded", String(!collapsed));
-            });
-        }
-    }
-    if (document.readyState === "loading") {
-        document.addEventListener("DOMContentLoaded", setup);
-    } else {
-        setup();
-    }
-})();
-</script>
-{% endmacro %}
-""")
-
-        legend_template = legend_template_str.substitute(
+        legend_template = LEGEND_TEMPLATE.substitute(
             legend_entries_html=legend_entries_html,
             map_var=map_var,
         )
@@ -412,164 +361,27 @@ def create_folium_map(gpx_file, output_file):
     plugins.MeasureControl().add_to(m)
 
     # Inject interactive waypoint toggle control (per-marker checkboxes)
-    import json as _json
-    marker_meta_json = _json.dumps(marker_meta)
-    map_var = m.get_name()
-    raw_tpl = """
-{% macro html(this, kwargs) %}
-<style>
-    .wpt-toggle-control {
-        background: rgba(255,255,255,0.95);
-        padding: 8px;
-        border-radius: 4px;
-        box-shadow: 0 1px 4px rgba(0,0,0,0.3);
-        max-height: 240px;
-        overflow: auto;
-        font: 12px/1.2 Arial, sans-serif;
-    }
-    .wpt-toggle-control h4 { margin: 0 0 6px 0; font-size: 13px; }
-    .wpt-toggle-actions { margin-bottom: 6px; }
-    .wpt-toggle-actions button { margin-right: 6px; }
-    .wpt-item { white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }
-</style>
-<script>
-(function() {
-    // Safely resolve the map object by name; avoid referencing the variable before it exists
-    var mapName = "__MAP__";
-    function getMap() {
-        try { return window[mapName]; } catch (e) { return null; }
-    }
-    var map = getMap();
-    var meta = __META__;
-    if (!meta || !meta.length) return;
-
-    function allReady() {
-        try {
-            for (var i=0;i<meta.length;i++) {
-                var id = meta[i].id;
-                var exists = false;
-                try { exists = !!eval(id); } catch(err) { exists = false; }
-                if (!exists) return false;
-            }
-            return true;
-        } catch(err) { return false; }
-    }
-
-    function build() {
-        window._wptRegistry = window._wptRegistry || {};
-        window._wptHidden = window._wptHidden || new Set();
-
-        // Resolve marker variables and optionally cluster groups
-        meta.forEach(function(e) {
-            try {
-                window._wptRegistry[e.id] = { marker: eval(e.id), cluster: e.cluster ? eval(e.cluster) : null };
-            } catch(err) {}
-        });
-
-        // Control UI
-        var Control = L.Control.extend({
-            options: { position: 'topleft' },
-            onAdd: function(map) {
-                var container = L.DomUtil.create('div', 'leaflet-control wpt-toggle-control');
-                var title = L.DomUtil.create('h4', '', container); title.textContent = 'Waypoints';
-                var actions = L.DomUtil.create('div', 'wpt-toggle-actions', container);
-                var btnAll = L.DomUtil.create('button', '', actions); btnAll.type='button'; btnAll.textContent='All';
-                var btnNone = L.DomUtil.create('button', '', actions); btnNone.type='button'; btnNone.textContent='None';
-
-                var list = L.DomUtil.create('div', '', container);
-
-                function setCheckedAll(flag) {
-                    var inputs = list.querySelectorAll('input[type=checkbox]');
-                    inputs.forEach(function(cb) {
-                        if (cb.checked !== flag) { cb.checked = flag; toggleOne(cb.dataset.id, flag); }
-                    });
-                }
-
-                btnAll.onclick = function(e) { setCheckedAll(true); };
-                btnNone.onclick = function(e) { setCheckedAll(false); };
-
-                meta.forEach(function(e, idx) {
-                    var row = L.DomUtil.create('div', 'wpt-item', list);
-                    var id = e.id;
-                    var cb = L.DomUtil.create('input', '', row); cb.type='checkbox'; cb.checked = !window._wptHidden.has(id); cb.dataset.id = id; cb.id = 'wpt_' + idx;
-                    var label = L.DomUtil.create('label', '', row); label.htmlFor = cb.id; label.textContent = ' ' + e.label;
-                    cb.onchange = function() { toggleOne(id, cb.checked); };
-                });
-
-                L.DomEvent.disableClickPropagation(container);
-                return container;
-            }
-        });
-
-        function toggleOne(id, visible) {
-            var rec = window._wptRegistry[id]; if (!rec || !rec.marker) return;
-            var mk = rec.marker;
-            var cl = rec.cluster;
-            if (visible) {
-                window._wptHidden.delete(id);
-                try { if (cl) cl.addLayer(mk); else map.addLayer(mk); } catch(err) {}
-            } else {
-                window._wptHidden.add(id);
-                try { if (cl) cl.removeLayer(mk); else map.removeLayer(mk); } catch(err) {}
-            }
-        }
-
-        function reapplyHidden() {
-            window._wptHidden.forEach(function(id) {
-                var rec = window._wptRegistry[id]; if (!rec || !rec.marker) return;
-                try { if (rec.cluster) { rec.cluster.removeLayer(rec.marker); } else if (map.hasLayer(rec.marker)) { map.removeLayer(rec.marker); } } catch(err){}
-            });
-        }
-
-        map.on('overlayadd', reapplyHidden);
-        map.on('layeradd', function() { reapplyHidden(); });
-
-        new Control().addTo(map);
-    }
-
-        function wait(attempts) {
-            // Ensure both map object and all markers exist
-            if (!map) { map = getMap(); }
-            if ((!!map && allReady()) || attempts <= 0) { if (!!map) build(); return; }
-            setTimeout(function() { wait(attempts - 1); }, 80);
-    }
-
-    wait(200);
-})();
-</script>
-{% endmacro %}
-"""
-    # Inject map var name and meta JSON via simple placeholder replacement
-    script_filled = raw_tpl.replace('__MAP__', map_var).replace('__META__', marker_meta_json)
-    toggle_tpl = Template(script_filled)
     macro = MacroElement()
-    macro._template = toggle_tpl
+    macro._template = WAYPOINT_TOGGLE_TEMPLATE
+    macro.map_var = m.get_name()
+    # Compact JSON, with '<' escaped so a label can't end the <script> early
+    macro.meta_json = json.dumps(marker_meta, separators=(',', ':'), ensure_ascii=False).replace('<', '\\u003c')
     m.get_root().add_child(macro)
 
-    # LayerControl toolbar helper to restore check-all/uncheck-all actions
     # Save map
-    m.save(output_file)
-    print(f"Interactive map saved to: {output_file}")
-    print(f"Open in browser: file://{os.path.abspath(output_file)}")
-    
-    # Print statistics
-    print(f"\nMap Statistics:")
-    print(f"- Route points: {len(track_points)}")
-    print(f"- Waypoints: {len(gpx.waypoints)}")
-    print(f"- Amenity types: {len(amenity_groups)}")
-    for amenity_type, group in amenity_groups.items():
-        count = len([wp for wp in gpx.waypoints if wp.type == amenity_type])
-        print(f"  - {amenity_type}: {count}")
+    save_map(m, output_file, gzip_copy)
+    print_map_report(output_file, len(track), len(waypoints), type_order)
 
-def main():
-    args = parse_args()
+def main(argv=None):
+    args = parse_args(argv)
     
     # Set default output filename
     if args.output is None:
         base_name = os.path.splitext(args.gpx_file)[0]
         args.output = f"{base_name}_map.html"
     
-    create_folium_map(args.gpx_file, args.output)
+    create_folium_map(args.gpx_file, args.output, args.cache_dir, simplify=not args.no_simplify, gzip_copy=args.gzip,
+                      simplify_tolerance=args.simplify_tolerance)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file